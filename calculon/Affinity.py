@@ -0,0 +1,71 @@
+import os
+import warnings
+
+
+class Placement:
+    """Assigns CPUs to producer / consumer processes following a placement policy."""
+    def __init__(self, policy):
+        """Initializes the placement. CPU affinity is set through `os.sched_setaffinity`, so it needs
+        Python 3.3 or newer on Linux; elsewhere, a warning is issued and processes are not pinned.
+
+        **Keyword arguments**
+
+        * policy -- "compact" to fill up the cores of one socket (physical package) before moving on to the next one, "spread" to place consecutive processes on different sockets, or a list whose element i is the CPU (or list of CPUs) of process number i (wrapping around if there are more processes).
+        """
+
+        self.supported = hasattr(os, "sched_setaffinity")
+
+        if not self.supported:
+            warnings.warn("CPU affinity requires os.sched_setaffinity, processes are not pinned", RuntimeWarning)
+
+        if policy in ("compact", "spread"):
+            self.order = _cpu_order(policy) if self.supported else []
+        elif isinstance(policy, (list, tuple)) and policy:
+            self.order = list(policy)
+        else:
+            raise ValueError("cpu_affinity must be 'compact', 'spread' or a non-empty list of CPUs")
+
+    def cpus(self, index):
+        """Returns the sorted list of CPUs of process number index, None if processes are not pinned."""
+        if not self.supported:
+            return None
+
+        cpus = self.order[index % len(self.order)]
+        return sorted(cpus) if isinstance(cpus, (list, tuple, set, frozenset)) else [cpus]
+
+
+def pin(cpus):
+    """Pins the calling process to the given CPUs, if any."""
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+
+
+def _cpu_order(policy):
+    """Returns the CPUs this process may run on, ordered for the given policy."""
+    packages = {}
+
+    for cpu in sorted(os.sched_getaffinity(0)):
+        package = _topology(cpu, "physical_package_id")
+        packages.setdefault(package, []).append((_topology(cpu, "core_id"), cpu))
+
+    groups = [[cpu for core, cpu in sorted(packages[package])] for package in sorted(packages)]
+
+    if policy == "compact":
+        return [cpu for group in groups for cpu in group]
+
+    # Spread: one CPU of every package in turn.
+    order = []
+
+    for i in range(0, max(len(group) for group in groups)):
+        order.extend(group[i] for group in groups if i < len(group))
+
+    return order
+
+
+def _topology(cpu, name):
+    """Reads a topology attribute of a CPU from sysfs, 0 if it is not available."""
+    try:
+        with open("/sys/devices/system/cpu/cpu{0}/topology/{1}".format(cpu, name)) as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return 0
@@ -0,0 +1,136 @@
+"""Asyncio execution mode. This module requires Python 3.5 or newer and is only
+imported by `Calculon.start_async()`."""
+import asyncio
+import inspect
+
+from .Consumer import _Consumer, _Sentinel
+from .Producer import _Producer
+
+
+async def _call(func, kwargs):
+    """Calls func, awaiting the result if func is a coroutine function."""
+    result = func(kwargs)
+
+    if inspect.isawaitable(result):
+        result = await result
+
+    return result
+
+
+class ProducerTask(_Producer):
+    """Producer that runs as a task on the event loop. The producer function is
+    usually a coroutine function; `_queue` is an asyncio.Queue, so values are put
+    on it with `await args["_queue"].put(value)`, which blocks while the queue is full."""
+    def __init__(self, func, kwargs, queue):
+        """Instantiates _Producer superclass."""
+        _Producer.__init__(self, func, kwargs, queue, None)
+
+    async def run(self):
+        """Runs the producer function once, see _Producer.run."""
+        self.kwargs["_name"] = self.name
+        self.kwargs["_queue"] = self.queue
+
+        try:
+            self._result = await _call(self.func, self.kwargs)
+
+            self.result = {
+                'name': self.name,
+                'result': self._result
+            }
+        except Exception as e:
+            self.result = {
+                'name': self.name,
+                'exception': e
+            }
+
+
+class ConsumerTask(_Consumer):
+    """Consumer that runs as a task on the event loop. The consumer function is usually
+    a coroutine function and receives the same arguments as described in _Consumer.run."""
+    def __init__(self, func, kwargs, queue):
+        """Instantiates _Consumer superclass."""
+        _Consumer.__init__(self, func, kwargs, queue, None)
+
+    async def run(self):
+        """Runs the consumer function once per value and once more for cleanup, see _Consumer.run."""
+        self._result = None
+        self.kwargs["_result"] = None
+
+        try:
+            while True:
+                value = await self.queue.get()
+
+                if isinstance(value, _Sentinel):
+                    break
+
+                if value is not None:
+                    # Special arguments get refreshed on every call.
+                    self.kwargs["_name"] = self.name
+                    self.kwargs["_value"] = value
+                    self.kwargs["_last_call"] = False
+                    self.kwargs["_result"] = await _call(self.func, self.kwargs)
+
+            # Last call to the consumer.
+            self.kwargs["_name"] = self.name
+            self.kwargs["_value"] = None
+            self.kwargs["_last_call"] = True
+            self._result = await _call(self.func, self.kwargs)
+
+            self.result = {
+                'name': self.name,
+                'result': self._result
+            }
+        except Exception as e:
+            self.result = {
+                'name': self.name,
+                'exception': e
+            }
+
+    async def shutdown(self):
+        """Puts an end-of-work marker on the queue, see _Consumer.shutdown."""
+        await self.queue.put(_Sentinel())
+
+
+async def _drain(queue, cons_tasks):
+    """Throws away the values put on the queue once every consumer has stopped, so that producers
+    (and end-of-work markers) are not left waiting on a full queue. While some consumers are running,
+    the values of a consumer whose function raised are left to them."""
+    if cons_tasks:
+        await asyncio.wait(cons_tasks)
+
+    while True:
+        await queue.get()
+
+
+async def start(calculon, max_queue_size):
+    """Runs producers and consumers of a Calculon instance as tasks on the running
+    event loop. See Calculon.start_async."""
+    if max_queue_size is None:
+        max_queue_size = 2 * max(len(calculon.cons_kwargs), 1)
+
+    queue = asyncio.Queue(max_queue_size)
+
+    prod_objs = [ProducerTask(calculon.prod_func, args, queue) for args in calculon.prod_kwargs]
+    cons_objs = [ConsumerTask(calculon.cons_func, args, queue) for args in calculon.cons_kwargs]
+
+    cons_tasks = [asyncio.ensure_future(cons_obj.run()) for cons_obj in cons_objs]
+    drain = asyncio.ensure_future(_drain(queue, cons_tasks))
+
+    # Wait for the producers.
+    await asyncio.gather(*[prod_obj.run() for prod_obj in prod_objs])
+
+    # Shut down the consumers and wait for them.
+    for cons_obj in cons_objs:
+        await cons_obj.shutdown()
+
+    await asyncio.gather(*cons_tasks)
+
+    drain.cancel()
+
+    try:
+        await drain
+    except asyncio.CancelledError:
+        pass
+
+    return {"producers": [prod_obj.result for prod_obj in prod_objs],
+            "consumers": [cons_obj.result for cons_obj in cons_objs]}
@@ -0,0 +1,99 @@
+import ctypes
+import time
+import threading
+import multiprocessing
+from multiprocessing.sharedctypes import RawValue
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from Queue import Queue as ThreadQueue, Full
+except ImportError:
+    from queue import Queue as ThreadQueue, Full
+
+
+class BoundedQueue:
+    """Queue that holds at most a given number of values and / or bytes."""
+    def __init__(self, max_items=0, max_bytes=0, use_threads=False, context=None):
+        """Initializes the queue. Calculon creates it when `max_queue_bytes` is given; for a
+        limit on the number of values alone, a plain bounded queue is used instead.
+
+        `put()` blocks while the queue is full. The size of a value is the size of its buffer for
+        strings / bytes and arrays, and the size of its pickle for anything else. A value larger
+        than `max_bytes` is let through once the queue is empty, so that it does not block forever.
+
+        **Keyword arguments**
+
+        * max_items -- maximum number of values in the queue, 0 for no limit;
+        * max_bytes -- maximum total size of values in the queue in bytes, 0 for no limit;
+        * use_threads -- a flag specifying if the queue is only used by threads (if False, it can be shared with processes);
+        * context -- multiprocessing context the queue is created with, for process start methods other than the default one.
+        """
+
+        self.max_bytes = max_bytes
+        self.size = RawValue(ctypes.c_longlong, 0)
+
+        if use_threads:
+            self.queue = ThreadQueue(max_items)
+            self.condition = threading.Condition()
+        else:
+            context = context or multiprocessing
+            self.queue = context.Queue(max_items)
+            self.condition = context.Condition()
+
+    def put(self, value, block=True, timeout=None):
+        """Puts a value on the queue, blocking while the queue is full. Raises Full
+        if the value could not be put without blocking / within timeout."""
+        size = _size_of(value) if self.max_bytes else 0
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self.condition:
+            while self.size.value and self.size.value + size > self.max_bytes:
+                remaining = None if deadline is None else deadline - time.time()
+
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Full
+
+                self.condition.wait(remaining)
+
+            self.size.value += size
+
+        try:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            self.queue.put((size, value), block, remaining)
+        except Full:
+            self._release(size)
+            raise
+
+    def get(self, block=True, timeout=None):
+        """Gets a value from the queue, making room for producers."""
+        size, value = self.queue.get(block, timeout)
+        self._release(size)
+        return value
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def _release(self, size):
+        if size:
+            with self.condition:
+                self.size.value -= size
+                self.condition.notify_all()
+
+
+def _size_of(value):
+    """Returns the size of value in bytes, as described in BoundedQueue.__init__."""
+    try:
+        view = memoryview(value)
+    except TypeError:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    size = view.itemsize
+
+    for dimension in view.shape:
+        size *= dimension
+
+    return size
@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+
+class LRUCache:
+    """Cache of consumer function results with least recently used eviction."""
+    def __init__(self, max_items):
+        """Initializes the cache. Consumer threads share one instance; consumer processes share one
+        that lives in a CacheManager server process and is reached through a proxy.
+
+        **Keyword arguments**
+
+        * max_items -- maximum number of results in the cache, the least recently used one is evicted to make room.
+        """
+
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns a (found, result) tuple for the given key."""
+        with self.lock:
+            try:
+                result = self.items.pop(key)
+            except KeyError:
+                return False, None
+
+            # Move to the most recently used end.
+            self.items[key] = result
+            return True, result
+
+    def put(self, key, result):
+        """Stores a result, evicting the least recently used one if the cache is full."""
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = result
+
+            while len(self.items) > self.max_items:
+                self.items.popitem(False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class CacheManager(BaseManager):
+    """Manager serving an LRUCache to consumer processes, `CacheManager().LRUCache(max_items)`
+    returns a proxy to a cache in the manager's server process."""
+    pass
+
+
+CacheManager.register("LRUCache", LRUCache, exposed=["get", "put", "__len__"])
@@ -1,12 +1,39 @@
-from multiprocessing import Queue, Pipe
+import time
+import threading
 
-from Consumer import ConsumerProcess, ConsumerThread
-from Producer import ProducerProcess, ProducerThread
+try:
+    from Queue import Queue as ThreadQueue, Empty, Full
+except ImportError:
+    from queue import Queue as ThreadQueue, Empty, Full
+
+from .Consumer import ConsumerProcess, ConsumerThread, _Sentinel, _Journal
+from .Producer import ProducerProcess, ProducerThread, _CANCEL_INTERVAL
+from .BoundedQueue import BoundedQueue
+from .Metrics import Histogram, QueueSampler
+from .SharedQueue import SharedMemoryQueue
+from .PartitionedQueue import PartitionedQueue
+from .WorkStealingQueue import WorkStealingQueue
+from .StartMethod import check_start_method, get_context
+from .Affinity import Placement
+from .SpillingQueue import SpillingQueue
+from .Cache import LRUCache, CacheManager
+from .Remote import QueueServer
+from .Stream import ResultStream
+from .Profile import check_memory_profiling, merge_stats, start_tracing, stop_tracing
+from .Trace import SpanBuffer, write_trace
 
 
 class Calculon:
     """Producer-consumer class. Responsible for initializing producers and consumers and controlling execution."""
-    def __init__(self, prod_func, prod_kwargs, prod_use_threads, cons_func, cons_kwargs, cons_use_threads):
+    def __init__(self, prod_func, prod_kwargs, prod_use_threads, cons_func, cons_kwargs, cons_use_threads,
+                 batch_size=None, batch_wait=None, shm_capacity=None, shm_slot_size=65536, pool=None,
+                 cons_autoscale=None, autoscale_interval=0.1, max_queue_size=None, max_queue_bytes=None,
+                 metrics=False, metrics_interval=0.1, chunk_size=100, partitioned=False, partition_key=None,
+                 work_stealing=False, distribution_chunk=1, start_method=None, preload=None,
+                 cpu_affinity=None, spill_after=None, spill_directory=None, spill_segment_size=64 * 1024 * 1024,
+                 cache_size=None, cache_key=None, remote_address=None, authkey=None, cancellable=False,
+                 deadline=None, max_retries=None, retry_delay=0, respawn=False, profile=None, profile_memory=False,
+                 trace=None, trace_buffer=100000):
         """Initializes Calculon.
 
         **Keyword arguments**
@@ -16,9 +43,111 @@ class Calculon:
         * prod_use_threads -- a flag specifying if threads are used to run producer code (if False, processes are used);
         * cons_func    -- consumer function that accepts one argument (dictionary of values)
         * cons_kwargs  -- a list of dictionaries, each representing a set of arguments for an instance of the consumer function
-        * cons_use_threads -- a flag specifying if threads are used to run consumer code (if False, processes are used).
+        * cons_use_threads -- a flag specifying if threads are used to run consumer code (if False, processes are used);
+        * batch_size -- if set, values travel through the queue in batches of up to this many values and the consumer function receives them as a `_values` list (see _Consumer.run);
+        * batch_wait -- if set along with batch_size, the longest time (in seconds) a value waits for its batch to fill up before it is sent / processed anyway;
+        * shm_capacity -- if set, values are passed through a ring buffer of this many shared memory slots instead of being pickled (see SharedMemoryQueue), producers block while all of the slots are in use;
+        * shm_slot_size -- size of a shared memory slot in bytes, i.e. the largest value that can be put on the queue;
+        * pool -- if set, a WorkerPool whose already running workers execute the producers and consumers, instead of starting new threads / processes on every run; prod_use_threads, cons_use_threads, the shared memory and metrics options are not used in this case;
+        * cons_autoscale -- if set, a (minimum, maximum) tuple of the number of consumer instances; `cons_kwargs` is then a single dictionary, copied for every consumer instance, and the number of consumers is adjusted while the producers run: one is added when the queue holds more values than the consumers processed in the last sampling interval, one is retired when the queue is empty;
+        * autoscale_interval -- how often (in seconds) the queue is sampled when autoscaling;
+        * max_queue_size -- if set, the maximum number of values (batches, if batching is enabled, or chunks of generator producers) in the queue; producers block while the queue is full;
+        * max_queue_bytes -- if set, the maximum total size of values in the queue in bytes (see BoundedQueue); producers block while the queue is full.
+
+        * metrics -- a flag specifying if producers and consumers keep track of how they spend their time and the depth of the queue is sampled during the run (see `start()`);
+        * metrics_interval -- how often (in seconds) the depth of the queue is sampled when collecting metrics;
+        * chunk_size -- the number of values a generator producer sends in one transfer when batching is not enabled (see _Producer.run); not used with the shared memory queue, a pool, partitioning or respawning, where values are sent one by one;
+        * partitioned -- a flag specifying if every consumer gets its own queue, with values routed by key so that all of the values with the same key go to the same consumer (see PartitionedQueue); max_queue_size then applies to each of the queues;
+        * partition_key -- function returning the key of a value when partitioning; by default, the value itself is the key. Keys should be strings, bytes, numbers, None or tuples / frozensets of those, which are routed the same way in every producer process (see PartitionedQueue);
+        * work_stealing -- a flag specifying if every consumer gets its own queue, filled by the producers in turns, and steals half of the backlog of the busiest other queue once its own is empty, blocking on its own queue while there is nothing to steal and looking at the other queues again every 50 ms (see WorkStealingQueue); max_queue_size then applies to each of the queues;
+        * distribution_chunk -- when work stealing, the number of consecutive values a producer puts on the same queue before moving on to the next one;
+        * start_method -- if set, the multiprocessing start method ("fork", "spawn" or "forkserver") of producer and consumer processes; with spawn and forkserver, the functions and their arguments are pickled, so the functions have to be defined at the top level of a module. Python 2 only supports fork, other start methods fall back to it with a warning;
+        * preload -- a list of names of modules the forkserver imports once, so that forked workers start with them already imported; only used with the forkserver start method, and only before the forkserver is started, i.e. by the first Calculon instance that starts a process with it.
+
+        * cpu_affinity -- if set, every producer / consumer process is pinned to a CPU (or a set of CPUs) following a placement policy: "compact", "spread" or an explicit list (see Placement); processes are numbered producers first, and threads are not pinned. Linux only, each process reports its CPUs under key "cpus" of its result;
+        * spill_after -- if set, the maximum number of values (batches, if batching is enabled) kept in memory; the values beyond that are written to segment files on disk instead of blocking the producers, and read back in order (see SpillingQueue);
+        * spill_directory -- the directory of the segment files; by default, a temporary directory that only exists while values are on disk;
+        * spill_segment_size -- size in bytes after which a new segment file is started; segment files are deleted once read;
+        * cache_size -- if set, outputs of the consumer function are cached by value, shared by all of the consumers (through a manager process if consumers are processes), and the least recently used of more than this many outputs are evicted; the consumer function is not called for a value found in the cache, its cached output is streamed instead and `_result` is left as it is (see _Consumer.run); caching requires the outputs to be streamed (see stream());
+        * cache_key -- function returning the cache key of a value; by default, the value itself is the key.
+
+        * remote_address -- if set, a (host, port) tuple: the queue is served over TCP on this address during `start()` and the consumers run on other nodes instead of in this process, started with `run_node()` (or `python -m calculon.Remote`); each element of cons_kwargs is a consumer slot taken by one of the remote consumers, and `start()` waits until all of them have connected and finished. cons_use_threads is not used in this mode, and the consumer function has to be importable on the nodes;
+        * authkey -- the key (bytes) nodes have to present to connect, required with remote_address.
+
+        * cancellable -- a flag specifying if the run can be cancelled before the producers are done: by a consumer (or producer) through the `_cancelled` event passed in its arguments, or by calling `cancel()`. Producers then get a Cancelled exception from `put()`, consumers stop taking values, the values left in the queue are discarded and `start()` returns the results so far (see `start()`);
+        * deadline -- if set, the number of seconds after which a run started with `start()` is cancelled; implies cancellable.
+
+        * max_retries -- if set, an exception raised by the consumer function only fails the value it was called with: the call is retried up to this many times, after which the value goes to the dead letters (see `start()`) and the consumer carries on with the next value;
+        * retry_delay -- number of seconds to wait before retrying a failed call;
+        * respawn -- a flag specifying if a consumer process that dies (killed, crashed in native code, ...) is replaced by a new one with the same arguments. The value it was processing is given to the replacement, unless that value has already killed max_retries + 1 processes (one, if max_retries is not set), in which case it goes to the dead letters. Consumer processes record every value in a journal file (in the temporary directory) before processing it, so that it can be handed over; the file is only read back once its consumer died, so values do not go through the calling process; generator producers send their values one by one in this mode. A consumer that dies during its last call is not replaced.
+
+        * profile -- if set, the path of a file the cProfile stats of all of the producers and consumers are written to, merged, in the pstats format (see `start()`); each worker is profiled from the start to the end of its `run()`, in its own thread / process. Python 3.12 and newer only allow one profiler at a time, so only one of several thread workers is profiled there;
+        * profile_memory -- a flag specifying if the peak memory use is traced with tracemalloc (Python 3.4 or newer) while profiling, per producer / consumer process, and once for the calling process if any of the workers are threads.
+
+        * trace -- if set, the path of a file a timeline of the run is written to in the Chrome Trace Event format, to be opened in Perfetto (ui.perfetto.dev) or chrome://tracing: every producer / consumer records spans for its calls to the producer / consumer function, its waits on the queue, its startup and its whole run (see _Producer.run and _Consumer.run), and the calling process records the start of every worker and the joins; every worker gets a row of its own;
+        * trace_buffer -- the maximum number of spans kept per worker, the oldest ones are dropped beyond that.
+
+        Producer and consumer processes report the number of seconds it took them to start up under key "startup" of their results.
+
+        If the queue is bounded by any of the options above (including shm_capacity), each producer reports the time it spent blocked on a full queue (see _Producer.run).
         """
 
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+
+        if shm_capacity and batch_size:
+            raise ValueError("shared memory queue does not support batching")
+
+        if cons_autoscale:
+            if pool is not None:
+                raise ValueError("worker pool does not support autoscaling")
+
+            if not 1 <= cons_autoscale[0] <= cons_autoscale[1]:
+                raise ValueError("cons_autoscale must be a (minimum, maximum) tuple with 1 <= minimum <= maximum")
+
+        if partitioned and (pool is not None or cons_autoscale or batch_size or shm_capacity or max_queue_bytes):
+            raise ValueError("partitioning cannot be combined with a pool, autoscaling, batching, "
+                             "the shared memory queue or max_queue_bytes")
+
+        if work_stealing and (pool is not None or cons_autoscale or batch_size or shm_capacity or max_queue_bytes or
+                              partitioned):
+            raise ValueError("work stealing cannot be combined with a pool, autoscaling, batching, "
+                             "the shared memory queue, max_queue_bytes or partitioning")
+
+        if spill_after and (pool is not None or shm_capacity or max_queue_size or max_queue_bytes or partitioned or
+                            work_stealing):
+            raise ValueError("spilling cannot be combined with a pool, the shared memory queue, max_queue_size, "
+                             "max_queue_bytes, partitioning or work stealing")
+
+        if cache_size and (pool is not None or batch_size):
+            raise ValueError("caching cannot be combined with a pool or batching")
+
+        if remote_address is not None:
+            if not authkey:
+                raise ValueError("distributed mode requires an authkey")
+
+            if pool is not None or cons_autoscale or shm_capacity or partitioned or work_stealing or cache_size or \
+                    metrics:
+                raise ValueError("distributed mode cannot be combined with a pool, autoscaling, the shared memory "
+                                 "queue, partitioning, work stealing, caching or metrics")
+
+        if (cancellable or deadline is not None) and (pool is not None or cons_autoscale or
+                                                      remote_address is not None):
+            raise ValueError("cancellation cannot be combined with a pool, autoscaling or distributed mode")
+
+        if (max_retries is not None or respawn) and (pool is not None or remote_address is not None):
+            raise ValueError("retries cannot be combined with a pool or distributed mode")
+
+        if respawn and (cons_autoscale or batch_size or shm_capacity or work_stealing):
+            raise ValueError("respawning cannot be combined with autoscaling, batching, the shared memory queue "
+                             "or work stealing")
+
+        if (profile is not None or trace is not None) and (pool is not None or remote_address is not None):
+            raise ValueError("profiling and tracing cannot be combined with a pool or distributed mode")
+
+        if distribution_chunk < 1:
+            raise ValueError("distribution_chunk must be a positive integer")
+
         self.cons_func = cons_func
         self.cons_kwargs = cons_kwargs
         self.cons_use_threads = cons_use_threads
@@ -27,7 +156,105 @@ class Calculon:
         self.prod_kwargs = prod_kwargs
         self.prod_use_threads = prod_use_threads
 
-        self.queue = Queue()
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self.pool = pool
+
+        self.cons_autoscale = cons_autoscale
+        self.autoscale_interval = autoscale_interval
+
+        self.max_queue_size = max_queue_size
+        self.spill_after = spill_after
+
+        self.cache_size = cache_size
+        self.cache_key = cache_key
+        self.cache = None
+
+        self.metrics = metrics
+        self.metrics_interval = metrics_interval
+        self.stall_timing = bool(max_queue_size or max_queue_bytes or shm_capacity)
+
+        # Chunks would be pickled instead of going through shared memory slots,
+        # cannot be routed as a whole when partitioning, and would be lost with
+        # a consumer that dies processing one.
+        self.chunk_size = None if shm_capacity or partitioned or respawn else chunk_size
+
+        self.partitioned = partitioned
+        self.work_stealing = work_stealing
+
+        self.remote_address = remote_address
+        self.authkey = authkey
+
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.respawn = respawn and not cons_use_threads
+
+        # Journals consumer processes record their values in, None once
+        # handled (see _respawn()).
+        self.journals = []
+
+        # Values given up on by the Calculon instance itself.
+        self.dead_letters = []
+
+        self.profile = profile
+        self.profile_memory = check_memory_profiling(profile_memory) if profile is not None else False
+
+        self.trace = trace
+        self.trace_buffer = trace_buffer
+
+        # Spans of the calling process during a traced run.
+        self.spans = None
+
+        self.cancellable = cancellable or deadline is not None
+        self.deadline = deadline
+
+        # Event of the current run, if it can be cancelled (see cancel()).
+        self.cancelled = None
+
+        # Queue of consumer outputs while a stream is running (see stream()).
+        self.output = None
+
+        # Queues and pipes shared with processes have to come from the context
+        # of the start method the processes are started with.
+        self.start_method = check_start_method(start_method, preload)
+        self.context = get_context(self.start_method)
+
+        self.placement = Placement(cpu_affinity) if cpu_affinity is not None else None
+        self.placed = 0
+
+        # With remote consumers, the queue is only read by the threads of the
+        # server, in this process.
+        use_threads = prod_use_threads and (cons_use_threads or remote_address is not None)
+        self.use_threads = use_threads
+
+        if pool is not None:
+            self.queue = pool.queue
+
+        elif shm_capacity:
+            self.queue = SharedMemoryQueue(shm_capacity, shm_slot_size, self.context)
+
+        elif partitioned:
+            self.queue = PartitionedQueue(len(cons_kwargs), partition_key, max_queue_size or 0,
+                                          use_threads, self.context)
+
+        elif work_stealing:
+            self.queue = WorkStealingQueue(len(cons_kwargs), distribution_chunk, max_queue_size or 0,
+                                           use_threads, self.context)
+
+        elif spill_after:
+            self.queue = SpillingQueue(spill_after, spill_directory, spill_segment_size,
+                                       use_threads, self.context)
+
+        elif max_queue_bytes:
+            self.queue = BoundedQueue(max_queue_size or 0, max_queue_bytes, use_threads, self.context)
+
+        # If everything runs in this process, values are passed between threads
+        # by reference, there is no need to pickle them and push through a pipe.
+        elif use_threads:
+            self.queue = ThreadQueue(max_queue_size or 0)
+        else:
+            self.queue = self.context.Queue(max_queue_size or 0)
 
     def start(self):
         """Starts producer and consumer threads / processes and controls the execution.
@@ -41,8 +268,72 @@ class Calculon:
 
             * value for key "producers" contains a list of results returned by each of the producer instance.
             * value for key "consumers" contains a list of results returned by each of the consumer instance.
+
+            If batching is enabled, the dictionary also contains the batch size used for the run under key "batch_size".
+            When autoscaling, "consumers" contains results of every consumer instance started during the run,
+            including the ones retired early. In distributed mode, "consumers" contains the results of the remote
+            consumers, in the order of their slots. If the run can be cancelled, the dictionary also contains a
+            "cancelled" flag, True if the run was cancelled; producers and consumers report whether they were
+            stopped by the cancellation the same way (see _Producer.run and _Consumer.run).
+
+            A consumer whose function raises reports the exception instead of a result and stops; the other
+            consumers of its queue take the values it leaves behind. Values no consumer is going to take, in
+            the partition of a consumer that stopped or in the queue once every consumer has stopped, are
+            thrown away, so that producers do not block on a full queue.
+
+            If retries or respawning are enabled, the dictionary also contains a "dead_letters" list of the values
+            that could not be processed, moved there from the consumer results (see _Consumer.run); values whose
+            consumer processes died have a RuntimeError as their exception. A consumer process that died reports
+            a RuntimeError as its exception as well, and the replacements started when respawning are appended to
+            "consumers".
+
+            If profiling is enabled, the dictionary also contains a "profile" dictionary: the pstats.Stats object of
+            the merged stats that were written to the file ("stats", None if no worker could be profiled) and a list
+            of the peak memory use of every producer / consumer process ("memory"), each a dictionary with the name
+            of the worker ("name"), "producer" or "consumer" ("role") and the peak number of bytes allocated ("peak");
+            thread workers are covered by one more entry for the calling process, named "main" with role "threads".
+            If tracing is enabled, the spans of the workers are written to the trace file instead of being returned.
+            If spilling is enabled, the dictionary also contains the number of values
+            written to disk since the queue was created under key "spilled".
+
+            If metrics are enabled, the dictionary also contains a "metrics" dictionary:
+
+            * "producers" and "consumers" -- lists of metrics of each of the producer / consumer instances, in the same order as the results (see _Producer.run and _Consumer.run), None for a process that died;
+            * "latency" -- Histogram of the duration of the calls to the consumer function, merged across all of the consumers;
+            * "queue_depth" -- list of (seconds since start, number of values in the queue) samples.
         """
 
+        if self.pool is not None:
+            return self.pool.submit_run(self.prod_func, self.prod_kwargs, self.cons_func, self.cons_kwargs,
+                                        self.batch_size, self.batch_wait)
+
+        # A cached output stands in for a call, which only works if outputs are streamed.
+        if self.cache_size and self.output is None:
+            raise ValueError("caching requires the outputs to be streamed (see stream())")
+
+        # Processes are placed in the same order on every run.
+        self.placed = 0
+
+        self.journals = []
+        self.dead_letters = []
+
+        origin = time.time()
+        self.spans = SpanBuffer(self.trace_buffer) if self.trace is not None else None
+
+        tracing = False
+
+        if self.profile_memory and (self.prod_use_threads or self.cons_use_threads):
+            tracing = start_tracing()
+
+        if self.cancellable:
+            self.cancelled = threading.Event() if self.use_threads else self.context.Event()
+
+        deadline = time.time() + self.deadline if self.deadline is not None else None
+
+        if self.metrics:
+            sampler = QueueSampler(self.queue, self.metrics_interval)
+            sampler.start()
+
         # Producers.
         prod_objs = []
         prod_pipes = []
@@ -51,49 +342,99 @@ class Calculon:
             args = self.prod_kwargs[id]
 
             if self.prod_use_threads:
-                prod_obj = ProducerThread(self.prod_func, args, self.queue)
+                prod_obj = ProducerThread(self.prod_func, args, self.queue, self.batch_size, self.batch_wait,
+                                          stall_timing=self.stall_timing, metrics=self.metrics,
+                                          chunk_size=self.chunk_size, cancelled=self.cancelled,
+                                          profile=self.profile is not None, trace_size=self._trace_size())
             else:
-                prod_pipes.append(Pipe())
-                prod_obj = ProducerProcess(self.prod_func, args, self.queue, prod_pipes[id][0])
+                prod_pipes.append(self.context.Pipe())
+                prod_obj = ProducerProcess(self.prod_func, args, self.queue, prod_pipes[id][0],
+                                           self.batch_size, self.batch_wait, stall_timing=self.stall_timing,
+                                           metrics=self.metrics, chunk_size=self.chunk_size,
+                                           start_method=self.start_method, cpus=self._place(),
+                                           cancelled=self.cancelled, profile=self.profile is not None,
+                                           profile_memory=self.profile_memory, trace_size=self._trace_size())
+
+            started = time.time()
 
             prod_objs.append(prod_obj)
             prod_obj.start()
 
+            if self.spans is not None:
+                self.spans.add("start producer {0}".format(id), started)
+
+        if self.remote_address is not None:
+            return self._start_remote(prod_objs, prod_pipes)
+
+        # Cache shared by the consumers.
+        if self.cache_size:
+            if self.cons_use_threads:
+                self.cache = LRUCache(self.cache_size)
+            else:
+                manager = CacheManager()
+                manager.start()
+                self.cache = manager.LRUCache(self.cache_size)
+
         # Consumers.
         cons_objs = []
         cons_pipes = []
 
-        for id in range(0, len(self.cons_kwargs)):
-            args = self.cons_kwargs[id]
+        if self.cons_autoscale:
+            cons_kwargs = [dict(self.cons_kwargs) for i in range(0, self.cons_autoscale[0])]
+        else:
+            cons_kwargs = self.cons_kwargs
 
-            if self.cons_use_threads:
-                cons_obj = ConsumerThread(self.cons_func, args, self.queue)
-            else:
-                cons_pipes.append(Pipe())
-                cons_obj = ConsumerProcess(self.cons_func, args, self.queue, cons_pipes[id][0])
+        for args in cons_kwargs:
+            self._start_consumer(args, cons_objs, cons_pipes)
 
-            cons_objs.append(cons_obj)
-            cons_obj.start()
+        # Adjust the number of consumers while the producers are running.
+        retired = 0
+
+        if self.cons_autoscale:
+            retired = self._autoscale(prod_objs, cons_objs, cons_pipes)
 
         # Join on the producers.
+        joined = time.time()
+
+        self._wait(prod_objs, deadline, True, cons_objs, cons_pipes)
+
         for prod_obj in prod_objs:
             prod_obj.join()
 
-        # Shut down  theconsumers.
-        for cons_obj in cons_objs:
-            cons_obj.shutdown()
+        if self.spans is not None:
+            self.spans.add("join producers", joined)
+
+        # Shut down the consumers after a cancellation; otherwise, every consumer that is
+        # still running gets an end-of-work marker while they are joined.
+        if self.cancellable and self.cancelled.is_set():
+            self._discard()
+
+            for cons_obj in cons_objs:
+                self._stop(cons_obj)
+
+        # Join on the consumers. Values left behind by a cancellation, or by consumers
+        # that stopped early, are not discarded until the consumers are done, as the
+        # end-of-work markers would go with them.
+        joined = time.time()
+
+        self._wait(cons_objs, deadline, False, cons_objs, cons_pipes, {None: retired})
 
-        # Join on the consumers.
         for cons_obj in cons_objs:
             cons_obj.join()
 
+        if self.spans is not None:
+            self.spans.add("join consumers", joined)
+
+        if any(not cons_obj.ended.value for cons_obj in cons_objs):
+            self._discard(True)
+
         # Collect result values.
         result = {"producers": [],
                   "consumers": []}
 
         for counter, prod_obj in enumerate(prod_objs):
             if isinstance(prod_obj, ProducerProcess):
-                res = prod_pipes[counter][1].recv()
+                res = _receive(prod_pipes[counter][1], prod_obj)
             else:
                 res = prod_obj.result
 
@@ -101,10 +442,491 @@ class Calculon:
 
         for counter, cons_obj in enumerate(cons_objs):
             if isinstance(cons_obj, ConsumerProcess):
-                res = cons_pipes[counter][1].recv()
+                res = _receive(cons_pipes[counter][1], cons_obj)
             else:
                 res = cons_obj.result
 
             result["consumers"] = result["consumers"] + [res]
 
+        if self.batch_size:
+            result["batch_size"] = self.batch_size
+
+        if self.spill_after:
+            result["spilled"] = self.queue.spilled()
+
+        if self.cancellable:
+            result["cancelled"] = self.cancelled.is_set()
+
+        if self.max_retries is not None or self.respawn:
+            result["dead_letters"] = list(self.dead_letters)
+
+            for res in result["consumers"]:
+                result["dead_letters"].extend(res.pop("dead_letters", []))
+
+        if self.profile is not None:
+            stats = []
+            memory = []
+
+            for role, results in [("producer", result["producers"]), ("consumer", result["consumers"])]:
+                for res in results:
+                    # Not there if the process died.
+                    profile = res.pop("profile", None)
+
+                    if profile is None:
+                        continue
+
+                    stats.append(profile["stats"])
+
+                    if "peak" in profile:
+                        memory.append({"name": res["name"], "role": role, "peak": profile["peak"]})
+
+            if tracing:
+                memory.append({"name": "main", "role": "threads", "peak": stop_tracing()})
+
+            result["profile"] = {"stats": merge_stats(stats, self.profile),
+                                 "memory": memory}
+
+        if self.trace is not None:
+            workers = [("calculon", self.spans.export())]
+
+            for role, results in [("producer", result["producers"]), ("consumer", result["consumers"])]:
+                for counter, res in enumerate(results):
+                    # Not there if the process died.
+                    trace = res.pop("trace", None)
+
+                    if trace is not None:
+                        workers.append(("{0} {1}".format(role, counter), trace))
+
+            write_trace(self.trace, origin, workers)
+            self.spans = None
+
+        if self.cache_size:
+            self.cache = None
+
+            if not self.cons_use_threads:
+                manager.shutdown()
+
+        if self.metrics:
+            sampler.stop()
+
+            # Not there if the process died.
+            metrics = {"producers": [res.pop("metrics", None) for res in result["producers"]],
+                       "consumers": [res.pop("metrics", None) for res in result["consumers"]],
+                       "latency": Histogram(),
+                       "queue_depth": sampler.samples}
+
+            for cons_metrics in metrics["consumers"]:
+                if cons_metrics is not None:
+                    metrics["latency"].merge(cons_metrics["latency"])
+
+            result["metrics"] = metrics
+
         return result
+
+    def _start_remote(self, prod_objs, prod_pipes):
+        """Serves the queue to remote consumers until all of the producers are done and every consumer
+        slot has reported its result."""
+        server = QueueServer(self.remote_address, self.authkey, self.queue, self.cons_func, self.cons_kwargs,
+                             self.batch_size, self.batch_wait)
+
+        try:
+            for prod_obj in prod_objs:
+                prod_obj.join()
+
+            # One end-of-work marker per consumer slot.
+            for i in range(0, len(self.cons_kwargs)):
+                self.queue.put(_Sentinel())
+
+            consumers = server.results(len(self.cons_kwargs))
+        finally:
+            server.close()
+
+        result = {"producers": [],
+                  "consumers": consumers}
+
+        for counter, prod_obj in enumerate(prod_objs):
+            if isinstance(prod_obj, ProducerProcess):
+                result["producers"].append(prod_pipes[counter][1].recv())
+            else:
+                result["producers"].append(prod_obj.result)
+
+        if self.batch_size:
+            result["batch_size"] = self.batch_size
+
+        if self.spill_after:
+            result["spilled"] = self.queue.spilled()
+
+        return result
+
+    def _start_consumer(self, args, cons_objs, cons_pipes, slot=None, retry=None):
+        """Starts a consumer thread / process and appends it (and its pipe, if any) to the lists. A
+        replacement of a dead consumer process takes over its slot, i.e. its queue when partitioning."""
+        slot = len(cons_objs) if slot is None else slot
+
+        if self.partitioned:
+            queue = self.queue.partition(slot)
+        elif self.work_stealing:
+            queue = self.queue.local(slot)
+        else:
+            queue = self.queue
+
+        if self.cons_use_threads:
+            cons_pipes.append(None)
+            cons_obj = ConsumerThread(self.cons_func, args, queue, self.batch_size, self.batch_wait,
+                                      metrics=self.metrics, output=self.output, cache=self.cache,
+                                      cache_key=self.cache_key, cancelled=self.cancelled,
+                                      max_retries=self.max_retries, retry_delay=self.retry_delay,
+                                      profile=self.profile is not None, trace_size=self._trace_size())
+        else:
+            journal = None
+
+            if self.respawn:
+                journal = _Journal()
+                self.journals.append(journal)
+
+            cons_pipes.append(self.context.Pipe())
+            cons_obj = ConsumerProcess(self.cons_func, args, queue, cons_pipes[-1][0],
+                                       self.batch_size, self.batch_wait, metrics=self.metrics,
+                                       output=self.output, start_method=self.start_method, cpus=self._place(),
+                                       cache=self.cache, cache_key=self.cache_key, cancelled=self.cancelled,
+                                       max_retries=self.max_retries, retry_delay=self.retry_delay,
+                                       journal=journal, retry=retry,
+                                       profile=self.profile is not None, profile_memory=self.profile_memory,
+                                       trace_size=self._trace_size())
+
+        cons_obj.slot = slot
+        started = time.time()
+
+        cons_objs.append(cons_obj)
+        cons_obj.start()
+
+        if self.spans is not None:
+            self.spans.add("start consumer {0}".format(len(cons_objs) - 1), started)
+
+    def _respawn(self, cons_objs, cons_pipes):
+        """Replaces the consumer processes that died, handing the value a process died with, read
+        from its journal, to its replacement (or to the dead letters). Returns the number of
+        replacements started."""
+        started = 0
+
+        for counter, cons_obj in enumerate(list(cons_objs)):
+            journal = self.journals[counter]
+
+            if journal is None or cons_obj.exitcode is None:
+                continue
+
+            record = journal.read()
+            journal.close()
+            self.journals[counter] = None
+
+            if cons_obj.exitcode == 0:
+                continue
+
+            # Died during the last call, nothing left to do for a replacement.
+            if isinstance(record, _Sentinel):
+                continue
+
+            retry = None
+
+            # The value is still being processed if the count has not moved since it was recorded.
+            if record is not None and cons_obj.processed.value == record[0]:
+                crashes = record[2] + 1
+
+                if crashes <= (self.max_retries or 0):
+                    retry = (record[1], crashes)
+                else:
+                    self.dead_letters.append({"value": record[1],
+                                              "exception": _died(cons_obj),
+                                              "attempts": crashes})
+
+            self._start_consumer(self.cons_kwargs[cons_obj.slot], cons_objs, cons_pipes, cons_obj.slot, retry)
+            started += 1
+
+        return started
+
+    def cancel(self):
+        """Cancels the current run, e.g. from another thread or a stream consumer. Only available if the
+        instance was created with cancellable (or deadline) set; does nothing if no run is in progress."""
+        if not self.cancellable:
+            raise ValueError("the run cannot be cancelled, set cancellable")
+
+        if self.cancelled is not None:
+            self.cancelled.set()
+
+    def _wait(self, objs, deadline, discard, cons_objs, cons_pipes, markers=None):
+        """Waits for the threads / processes to finish, cancelling the run once the deadline has passed
+        and replacing consumer processes that die if respawning is enabled. If discard is set (while the
+        producers run), values put on the queue after a cancellation are thrown away, so that no producer
+        stays blocked on a full queue (or, in a process, on the data it has yet to send), and so are the
+        values no consumer is going to take (see _drain()). If markers is set, end-of-work markers are
+        put for the consumers that are still running (see _shutdown())."""
+        while True:
+            running = [obj for obj in objs if obj.is_alive()]
+            alive = [cons_obj for cons_obj in cons_objs if cons_obj.is_alive()]
+
+            # Check for dead consumers after the others, lest one dies in between.
+            if self.respawn and self._respawn(cons_objs, cons_pipes):
+                continue
+
+            self._drain(alive, discard)
+
+            if not running:
+                break
+
+            if deadline is not None and time.time() >= deadline:
+                self.cancelled.set()
+
+            cancelled = self.cancelled is not None and self.cancelled.is_set()
+
+            if discard and cancelled:
+                self._discard()
+
+            if markers is not None and not cancelled:
+                self._shutdown(cons_objs, markers)
+
+            running[0].join(_CANCEL_INTERVAL)
+
+    def _drain(self, alive, producing):
+        """Throws away the values no consumer is going to take while producers are running (producing is
+        set), so that they are not left blocked on a full queue: those in the queue of a partition whose
+        consumer has stopped (e.g. because its function raised), or in the queue once every consumer has
+        stopped; values that arrive shortly after are waited for, so that a producer blocked on such a
+        queue is not held up from one call to the next. While other consumers are running, the values of
+        a consumer that stopped are left to them; when work stealing, they steal the whole queue (see
+        WorkStealingQueue.abandon()). alive is the list of consumers still running."""
+        slots = set(cons_obj.slot for cons_obj in alive)
+
+        if self.partitioned:
+            for slot, queue in enumerate(self.queue.queues):
+                if producing and slot not in slots:
+                    _empty(queue, True)
+        elif not alive:
+            if producing:
+                self._discard(True)
+        elif self.work_stealing:
+            for slot in range(0, len(self.queue.queues)):
+                if slot not in slots:
+                    self.queue.abandon(slot)
+
+    def _shutdown(self, cons_objs, markers):
+        """Puts end-of-work markers on the queue (on the queue of every consumer, when there is one per
+        consumer) until there is one for every consumer that is still running and has not taken one yet.
+        Consumers that stopped early do not get one, lest their markers fill a bounded queue nobody takes
+        values from. A marker is put with a timeout, and tried again on the next call if the queue stays
+        full. markers is a dictionary with the number of markers put so far on every queue (None for the
+        shared queue), updated in place."""
+        own = self.partitioned or self.work_stealing
+        queues = {}
+
+        for cons_obj in cons_objs:
+            ended, running = queues.setdefault(cons_obj.slot if own else None, ([], []))
+
+            if cons_obj.ended.value:
+                ended.append(cons_obj)
+            elif cons_obj.is_alive():
+                running.append(cons_obj)
+
+        for key, (ended, running) in queues.items():
+            # Markers that have not been taken yet are on their way to running consumers.
+            while running and len(running) > markers.get(key, 0) - len(ended):
+                try:
+                    running[0].shutdown(True, _CANCEL_INTERVAL)
+                except Full:
+                    break
+
+                markers[key] = markers.get(key, 0) + 1
+
+    def _stop(self, cons_obj):
+        """Shuts a consumer down after a cancellation. Consumers stop without taking their end-of-work
+        marker once they notice the cancellation, so the marker is only put while the consumer is still
+        running, lest it block on a full queue forever."""
+        while cons_obj.is_alive():
+            try:
+                cons_obj.shutdown(True, _CANCEL_INTERVAL)
+                break
+            except Full:
+                pass
+
+    def _discard(self, wait=False):
+        """Throws away the values in the queue (in all of the queues, when there is one per consumer).
+        If wait is set, values that are still on their way through the pipe of a process queue are
+        waited for a moment, so that they are not left behind in a pipe nobody reads from."""
+        for queue in getattr(self.queue, "queues", [self.queue]):
+            _empty(queue, wait)
+
+    def _trace_size(self):
+        """Returns the size of the span buffer of a worker, None if the run is not traced."""
+        return self.trace_buffer if self.trace is not None else None
+
+    def _place(self):
+        """Returns the CPUs of the next process to start, None if processes are not pinned."""
+        if self.placement is None:
+            return None
+
+        self.placed += 1
+        return self.placement.cpus(self.placed - 1)
+
+    def _autoscale(self, prod_objs, cons_objs, cons_pipes):
+        """Samples queue depth and consumer throughput until all of the producers are done and the
+        queue is empty, starting a consumer when the queue holds more values than were processed
+        since the last sample and retiring one when the queue is empty. A consumer is retired by
+        putting an end-of-work marker on the queue, which is taken by an idle consumer. Returns the
+        number of retired consumers."""
+        minimum, maximum = self.cons_autoscale
+        retired = 0
+        processed = 0
+
+        while True:
+            running = [prod_obj for prod_obj in prod_objs if prod_obj.is_alive()]
+
+            # Keep going after the producers are done while there is a backlog.
+            if not running and self.queue.qsize() == 0:
+                break
+
+            if running:
+                running[0].join(self.autoscale_interval)
+            else:
+                time.sleep(self.autoscale_interval)
+
+            self._drain([cons_obj for cons_obj in cons_objs if cons_obj.is_alive()], True)
+
+            depth = self.queue.qsize()
+            total = sum(cons_obj.processed.value for cons_obj in cons_objs)
+            active = len(cons_objs) - retired
+
+            if depth > total - processed and active < maximum:
+                self._start_consumer(dict(self.cons_kwargs), cons_objs, cons_pipes)
+            elif depth == 0 and active > minimum:
+                cons_objs[0].shutdown()
+                retired += 1
+
+            processed = total
+
+        return retired
+
+    def stream(self, buffer_size=1000):
+        """Starts the run in the background and returns an iterator over the values returned by the
+        consumer function, yielded as soon as each call returns rather than once the run is over. The
+        return values of the last ("cleanup") calls are not yielded, they end up in the consumer results
+        as usual; consumer functions that yield per-value outputs should therefore not accumulate them
+        in `_result`, which keeps the memory use flat however long the run is.
+
+        Outputs of different consumers are interleaved in the order they are produced. Iterate to the end:
+        consumers block while the buffer is full, so an abandoned stream keeps the run from finishing.
+
+        **Keyword arguments**
+
+        * buffer_size -- the number of outputs held until they are taken by the iterator.
+
+        **Returns**
+            Returns a ResultStream iterator. Once it is exhausted, its `result` attribute holds the same
+            dictionary as `start()` returns.
+        """
+        if self.pool is not None:
+            raise ValueError("worker pool does not support streaming")
+
+        if self.remote_address is not None:
+            raise ValueError("distributed mode does not support streaming")
+
+        return ResultStream(self, buffer_size)
+
+    @staticmethod
+    def map(func, iterable, workers=4, use_threads=False, chunksize=1, max_pending=None):
+        """Applies func to every value of iterable in `workers` consumer threads / processes and
+        returns the list of results, in the order of the values. See `imap()`."""
+        return list(Calculon.imap(func, iterable, workers, use_threads, chunksize, max_pending))
+
+    @staticmethod
+    def imap(func, iterable, workers=4, use_threads=False, chunksize=1, max_pending=None):
+        """Lazy version of `map()`. The iterable is read in a producer thread as results are taken,
+        `chunksize` values at a time, each chunk being one value on the queue; results of chunks that
+        finish early wait in a reorder buffer until the chunks before them are done.
+
+        If func raises an exception for any value, it is raised by the iterator once the chunks still
+        being processed are done; the same happens if the iterator is closed early.
+
+        **Keyword arguments**
+
+        * func -- function applied to every value; with processes, the values and results are pickled;
+        * iterable -- the values, read lazily;
+        * workers -- number of consumer instances;
+        * use_threads -- a flag specifying if threads are used to run func (if False, processes are used);
+        * chunksize -- number of values sent to a consumer at once;
+        * max_pending -- the maximum number of chunks read from the iterable and not yet yielded, including the ones in the reorder buffer; twice the number of workers by default.
+
+        **Returns**
+            Returns an iterator over the results of func, in the order of the values.
+        """
+        from .Map import imap
+
+        _check_map_args(workers, chunksize, max_pending)
+        return imap(func, iterable, workers, use_threads, chunksize, max_pending or 2 * workers, True)
+
+    @staticmethod
+    def imap_unordered(func, iterable, workers=4, use_threads=False, chunksize=1, max_pending=None):
+        """Same as `imap()`, except that results are yielded as soon as their chunk is done, in no particular order."""
+        from .Map import imap
+
+        _check_map_args(workers, chunksize, max_pending)
+        return imap(func, iterable, workers, use_threads, chunksize, max_pending or 2 * workers, False)
+
+    def start_async(self, max_queue_size=None):
+        """Runs every producer and consumer instance as a task on the running asyncio event loop
+        instead of a thread / process, and controls the execution. Requires Python 3.5 or newer.
+
+        The producer and consumer functions can be coroutine functions (plain functions work as
+        well) and receive the same special arguments as in `start()`, except that `_queue` is an
+        asyncio.Queue: producers put values on it with `await args["_queue"].put(value)`, which
+        blocks while the queue is full. `prod_use_threads`, `cons_use_threads` and the queue
+        options given to the constructor are not used in this mode.
+
+        **Keyword arguments**
+
+        * max_queue_size -- the number of values the queue can hold before producers have to wait; by default, `max_queue_size` given to the constructor or, if that is not set either, twice the number of consumers.
+
+        **Returns**
+            Returns a coroutine, which when awaited returns the same dictionary as `start()`.
+        """
+        from .Async import start
+
+        if max_queue_size is None:
+            max_queue_size = self.max_queue_size
+
+        return start(self, max_queue_size)
+
+
+def _receive(pipe, worker):
+    """Receives the result of a worker process, or makes one up if the process died without sending it."""
+    if worker.exitcode and not pipe.poll():
+        return {"name": worker.name,
+                "exception": _died(worker)}
+
+    return pipe.recv()
+
+
+def _empty(queue, wait=False):
+    """Throws away the values in a queue, see Calculon._discard."""
+    while True:
+        try:
+            queue.get(wait, _CANCEL_INTERVAL)
+        except Empty:
+            break
+
+    if isinstance(queue, SharedMemoryQueue):
+        queue.release()
+
+
+def _died(worker):
+    return RuntimeError("process {0} died with exit code {1}".format(worker.name, worker.exitcode))
+
+
+def _check_map_args(workers, chunksize, max_pending):
+    """Validates the arguments of Calculon.imap() and Calculon.imap_unordered()."""
+    if workers < 1:
+        raise ValueError("workers must be a positive integer")
+
+    if chunksize < 1:
+        raise ValueError("chunksize must be a positive integer")
+
+    if max_pending is not None and max_pending < 1:
+        raise ValueError("max_pending must be a positive integer")
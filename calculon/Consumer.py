@@ -1,13 +1,103 @@
+import os
 import time
 import uuid
+import ctypes
+import struct
 import logging
+import tempfile
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from threading import Thread
-from multiprocessing import Process, Event
+from multiprocessing.sharedctypes import RawValue
+
+from .Metrics import Histogram
+from .Producer import _Chunk
+from .SharedQueue import SharedMemoryQueue
+from .StartMethod import _StartMethodProcess
+from .Affinity import pin
+from .Profile import _WorkerProfile
+from .Trace import SpanBuffer
+
+
+class _Sentinel:
+    """End-of-work marker. One instance is put on the queue for every consumer
+    that is shut down; it travels behind all of the values that were put before it."""
+    pass
+
+
+# A journal file starts with the length of the pickle of its record, 0 while it is being written.
+_LENGTH = struct.Struct("<Q")
+
+
+class _Journal:
+    """File in which a consumer process records the value it is working on, so that the value can be
+    handed to a replacement if the process dies. A record is only copied into the page cache of the
+    file, it does not go through the calling process, which only reads it back once the consumer died."""
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="calculon-journal-")
+        os.close(fd)
+
+        self._fd = None
+
+    def __getstate__(self):
+        # File descriptors are per process.
+        state = self.__dict__.copy()
+        state["_fd"] = None
+        return state
+
+    def write(self, record):
+        """Replaces the record. If the process dies halfway, the file reads as having no record."""
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY)
+
+        self._write(0, _LENGTH.pack(0))
+        self._write(_LENGTH.size, data)
+        self._write(0, _LENGTH.pack(len(data)))
+
+    def read(self):
+        """Returns the last record, or None if there is none."""
+        with open(self.path, "rb") as journal:
+            header = journal.read(_LENGTH.size)
+
+            if len(header) < _LENGTH.size:
+                return None
+
+            length = _LENGTH.unpack(header)[0]
+
+            if not length:
+                return None
+
+            return pickle.loads(journal.read(length))
+
+    def close(self):
+        """Deletes the file, once the consumer is done with it."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+        os.remove(self.path)
+
+    def _write(self, offset, data):
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        view = memoryview(data)
+
+        while view:
+            view = view[os.write(self._fd, view):]
 
 
 class _Consumer:
     """Consumer class."""
-    def __init__(self, func, kwargs, queue, pipe):
+    def __init__(self, func, kwargs, queue, pipe, batch_size=None, batch_wait=None, metrics=False,
+                 output=None, cache=None, cache_key=None, cancelled=None, max_retries=None, retry_delay=0,
+                 journal=None, retry=None, profile=False, profile_memory=False, trace_size=None):
         """Consumer superclass, contains all of the functionality. Calculon does not deal with this
         class directly, rather it instantiates ConsumerThread or ConsumerProcess that inherit from
         _Consumer and from either Thread or Process classes.
@@ -17,7 +107,21 @@ class _Consumer:
         * queue -- instance of multiprocessing.Queue;
         * func -- function that processes values received from the queue, once at a time;
         * kwargs -- a dictionary of arguments passed to func;
-        * pipe -- end of a multiprocessing.Pipe() to which consumer can write the results.
+        * pipe -- end of a multiprocessing.Pipe() to which consumer can write the results;
+        * batch_size -- if set, the queue carries lists of values and func is called with up to this many values at a time;
+        * batch_wait -- if set along with batch_size, func is called with a partial batch once the oldest collected value has waited this many seconds;
+        * metrics -- a flag specifying if the consumer keeps track of how it spends its time (see `run()`);
+        * output -- if set, a queue on which the return value of every call to func (except the last one) is put as soon as the call returns;
+        * cache -- if set, an LRUCache (or a proxy to one) of outputs of func, shared with other consumers; func is then not called for a value whose key is in the cache, the cached output is put on output instead;
+        * cache_key -- function returning the cache key of a value (the value itself if not set);
+        * cancelled -- if set, an Event that is set once the run is cancelled; the consumer then stops taking values from the queue;
+        * max_retries -- if set, an exception raised by func for a value no longer stops the consumer: func is called again up to this many times, and if it still fails, the value goes to the dead letters of the consumer (see `run()`) and the consumer moves on to the next value;
+        * retry_delay -- number of seconds to wait before calling func again for a value that failed;
+        * journal -- if set, a _Journal in which a process consumer records every value before passing it to func, so that the value can be given to a replacement if the process dies (see Calculon);
+        * retry -- if set, a (value, crashes) tuple of a value whose consumer died processing it; it is processed first, counting the crashes as failed attempts;
+        * profile -- a flag specifying if `run()` is profiled with cProfile;
+        * profile_memory -- a flag specifying if the peak memory use of a consumer process is traced with tracemalloc while profiling;
+        * trace_size -- if set, the consumer records timed spans in a ring buffer of this many spans (see `run()`).
         """
 
         self.name = uuid.uuid1().hex
@@ -25,10 +129,32 @@ class _Consumer:
         self.kwargs = kwargs if kwargs else {}
         self.queue = queue
         self.pipe = pipe
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.metrics = metrics
+        self.output = output
+        self.cache = cache
+        self.cache_key = cache_key
+        self.cancelled = cancelled
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.journal = journal
+        self.retry = retry
+        self.profile = profile
+        self.profile_memory = profile_memory
+        self.trace_size = trace_size
+
+        # Number of values processed so far, readable from the Calculon instance
+        # while the consumer is running.
+        self.processed = RawValue(ctypes.c_ulong, 0)
+
+        # Set once the consumer has taken its end-of-work marker, so that the Calculon
+        # instance knows how many of the markers it put are still on their way.
+        self.ended = RawValue(ctypes.c_bool, False)
 
-        # Exit event indicating that there will be no items out on the queue
-        # anymore and that it's safe to exit once queue is empty.
-        self.exit = Event()
+        # Values received but not yet passed to func (batch mode only).
+        self._pending = []
+        self._finished = False
 
     def run(self):
         """Runs the producer function once.
@@ -37,11 +163,12 @@ class _Consumer:
 
             None
 
-        Consumer will repeteadly try to get a value from the queue until all producers have
-        shutdown and the queue is not empty. Each time it succeeds, the value is passed to
-        the consumer function to process the value. Once there are no more values in the
-        queue and all of the producers have stopped, each of the consumers will be called
-        once more, to allow to perform any sort of cleanup that might be required.
+        Consumer blocks on the queue and wakes up as soon as a value arrives. Each value is
+        passed to the consumer function to process it. Once the consumer receives the
+        end-of-work marker placed on the queue by `shutdown()` (that is, after all of the
+        producers have stopped and every value ahead of the marker has been taken), the
+        consumer function is called once more, to allow to perform any sort of cleanup
+        that might be required.
 
         Along with each call to the consumer function, the following values are passed in
         the argument dictionary.
@@ -50,38 +177,143 @@ class _Consumer:
         * _value -- value from the queue to process during this call;
         * _last_call -- a flag that when set to `True` indicates that this is the last "cleanup" call to the consumer. Also note that if If `_last_call` is `True`, `_value` is `None`.
         * _result -- contains the return value of the previous call to the consumer function. Set to None on the first call.
+        * _cancelled -- only if the run can be cancelled: an Event that stops the run as soon as it is set with `set()`, e.g. once the consumer has found what the run is looking for. Values still in the queue are not processed, though every consumer still gets its last call.
+
+        If batching is enabled, `_value` is always `None` and the values are passed instead as
+
+        * _values -- a list of up to `batch_size` values to process during this call (`None` on the last call).
+
+        If metrics are enabled, the result dictionary also contains a "metrics" dictionary with the name of
+        the consumer, the number of values processed ("items"), the number of seconds spent in the consumer
+        function ("busy") and waiting on the queue ("idle"), and a Histogram of the duration of the calls to
+        the consumer function ("latency"; one call per batch when batching).
+
+        If the consumer runs in a process, the result dictionary also contains the number of seconds between
+        the start of the process and the start of this method ("startup") and, if CPU affinity is set, the list
+        of CPUs the process is pinned to ("cpus").
+
+        If profiling is enabled, the result dictionary also contains a "profile" dictionary with the cProfile stats
+        of this method ("stats") and, if memory is traced, the peak number of bytes allocated by the process ("peak").
+
+        If tracing is enabled, the result dictionary also contains the spans recorded by the consumer under "trace"
+        (see SpanBuffer.export): "startup" (process only), "run" for this method, "queue.get" for every wait on the
+        queue and "cons_func" for every call to the consumer function.
+
+        If retries are enabled, the result dictionary also contains a "dead_letters" list, with a dictionary for
+        every value (list of values, when batching) func failed to process: the value ("value"), the exception
+        of the last attempt ("exception") and the number of attempts ("attempts"). The failed calls do not
+        change `_result`.
+
+        If the run can be cancelled, the result dictionary also contains a "cancelled" flag, True if the consumer
+        stopped because the run was cancelled.
+
+        If the consumer function raises an exception (and retries are not enabled), the result dictionary contains
+        it under "exception" instead of "result" and the consumer stops taking values off the queue; the values
+        are left to the other consumers of the queue, and thrown away by Calculon once there are none left (see
+        Calculon.start).
+
+        If caching is enabled, the result dictionary also contains a "cache" dictionary with the number of values
+        whose result was found in the cache ("hits") and of values passed to the consumer function ("misses").
+        Only the outputs put on `output` are cached: a value found in the cache has its cached output put on
+        `output` and leaves `_result` as it is, so caching only makes sense for consumer functions whose return
+        value depends on `_value` alone (see Calculon.stream()).
         """
+        start_time = getattr(self, "start_time", None)
+        startup = time.time() - start_time if start_time is not None else None
+        cpus = getattr(self, "cpus", None)
+
+        profile = _WorkerProfile(self.profile_memory, self.pipe is not None) if self.profile else None
+
+        self._spans = SpanBuffer(self.trace_size) if self.trace_size else None
+        run_started = time.time()
+
+        if self._spans is not None and start_time is not None:
+            self._spans.add("startup", start_time, run_started)
 
         self._result = None
         self.kwargs["_result"] = None
 
+        self._busy = 0.0
+        self._idle = 0.0
+        self._hits = 0
+        self._misses = 0
+        self._latency = Histogram() if self.metrics else None
+        self._stopped = False
+        self._dead = []
+
+        if self.cancelled is not None:
+            self.kwargs["_cancelled"] = self.cancelled
+
         try:
-            while not (self.exit.is_set() and self.queue.qsize() == 0):
-                # Value to process.
-                value = None
-
-                # We use a non-blocking call to avoid deadlocking when
-                # the queue is empty.
-                try:
-                    value = self.queue.get(block=False)
-                except:
-                    time.sleep(1)
+            pin(cpus)
+
+            if self.retry is not None:
+                self._call(self.retry[0], crashes=self.retry[1])
+
+            while not self._cancelled():
+                if self.metrics or self._spans is not None:
+                    waited = time.time()
+
+                if self.batch_size:
+                    values = self._get_batch()
+
+                    if self.metrics:
+                        self._idle += time.time() - waited
+
+                    if self._spans is not None:
+                        self._spans.add("queue.get", waited)
+
+                    # Nothing left and the end-of-work marker was received.
+                    if not values or self._cancelled():
+                        break
+
+                    self._call(None, values)
                     continue
 
-                if value is not None:
+                # Blocking call, the end-of-work marker put by shutdown()
+                # guarantees that we do not wait forever.
+                value = self.queue.get()
+
+                if self.metrics:
+                    self._idle += time.time() - waited
 
-                        # Special arguments get refreshed on every call.
-                        self.kwargs["_name"] = self.name
-                        self.kwargs["_value"] = value
-                        self.kwargs["_last_call"] = False
-                        self.kwargs["_result"] = self.func(self.kwargs)
+                if self._spans is not None:
+                    self._spans.add("queue.get", waited)
+
+                if isinstance(value, _Sentinel):
+                    self.ended.value = True
+                    break
+
+                if self._cancelled():
+                    break
+
+                if isinstance(value, _Chunk):
+                    for value in value:
+                        if self._cancelled():
+                            break
+
+                        if value is not None:
+                            self._call(value)
+                elif value is not None:
+                    self._call(value)
 
             # Last call to the consumer.
+            if self.journal is not None:
+                self.journal.write(_Sentinel())
+
             self.kwargs["_name"] = self.name
             self.kwargs["_value"] = None
             self.kwargs["_last_call"] = True
+
+            if self.batch_size:
+                self.kwargs["_values"] = None
+
+            started = time.time()
             self._result = self.func(self.kwargs)
 
+            if self._spans is not None:
+                self._spans.add("cons_func", started)
+
             # Set result dictionary.
             self.result = {
                 'name': self.name,
@@ -93,6 +325,42 @@ class _Consumer:
                 'name': self.name,
                 'exception': e
             }
+        finally:
+            # The slot of the last value taken from a shared memory queue is only
+            # handed back by the next get(), which this consumer will not make.
+            if isinstance(self.queue, SharedMemoryQueue):
+                self.queue.release()
+
+        if startup is not None:
+            self.result['startup'] = startup
+
+        if self.cancelled is not None:
+            self.result['cancelled'] = self._stopped
+
+        if self.max_retries is not None:
+            self.result['dead_letters'] = self._dead
+
+        if self.cache is not None:
+            self.result['cache'] = {'hits': self._hits, 'misses': self._misses}
+
+        if cpus is not None:
+            self.result['cpus'] = cpus
+
+        if self.metrics:
+            self.result['metrics'] = {
+                'name': self.name,
+                'items': self.processed.value,
+                'busy': self._busy,
+                'idle': self._idle,
+                'latency': self._latency
+            }
+
+        if profile is not None:
+            self.result['profile'] = profile.stop()
+
+        if self._spans is not None:
+            self._spans.add("run", run_started)
+            self.result['trace'] = self._spans.export()
 
         # For multiprocessing we need to communicate results
         # through a pipe.
@@ -100,23 +368,146 @@ class _Consumer:
             self.pipe.send(self.result)
             self.pipe.close()
 
-    def shutdown(self):
-        """Sets the exit flag. The exit flag is used by the `run()` code
-        to check if the consumer can be shutdown safely. It is called from
-        the Calculon instance and indicates that all of the producers have
-        stopped running."""
-        self.exit.set()
+    def _call(self, value, values=None, crashes=0):
+        """Passes a value (or a batch of values) to the consumer function."""
+        if self.journal is not None:
+            self.journal.write((self.processed.value, value, crashes))
+
+        # Special arguments get refreshed on every call.
+        self.kwargs["_name"] = self.name
+        self.kwargs["_value"] = value
+        self.kwargs["_last_call"] = False
+
+        if self.batch_size:
+            self.kwargs["_values"] = values
+
+        found = False
+
+        if self.cache is not None:
+            key = self.cache_key(value) if self.cache_key else value
+            found, result = self.cache.get(key)
+
+        failed = False
+
+        if found:
+            self._hits += 1
+        elif self.metrics:
+            started = time.time()
+            failed = self._apply(value, values, crashes)
+            elapsed = time.time() - started
+
+            self._busy += elapsed
+            self._latency.add(elapsed)
+        else:
+            failed = self._apply(value, values, crashes)
+
+        if self.cache is not None and not found:
+            self._misses += 1
+
+            if not failed:
+                self.cache.put(key, self.kwargs["_result"])
+
+        self.processed.value += len(values) if self.batch_size else 1
+
+        if self.output is not None and not failed:
+            self.output.put(result if found else self.kwargs["_result"])
+
+    def _apply(self, value, values, attempts):
+        """Calls the consumer function, retrying if retries are enabled. Returns True if the value
+        went to the dead letters."""
+        while True:
+            attempts += 1
+            started = time.time()
+
+            try:
+                self.kwargs["_result"] = self.func(self.kwargs)
+                return False
+            except Exception as e:
+                if self.max_retries is None:
+                    raise
+
+                if attempts > self.max_retries:
+                    self._dead.append({'value': values if self.batch_size else value,
+                                       'exception': e,
+                                       'attempts': attempts})
+                    return True
+            finally:
+                if self._spans is not None:
+                    self._spans.add("cons_func", started)
+
+            if self.retry_delay:
+                time.sleep(self.retry_delay)
+
+    def _cancelled(self):
+        """Returns True if the run has been cancelled, remembering that the consumer stopped early."""
+        if self.cancelled is not None and self.cancelled.is_set():
+            self._stopped = True
+
+        return self._stopped
+
+    def _get_batch(self):
+        """Collects up to `batch_size` values for the next call to the consumer function.
+        Blocks until the batch is full, `batch_wait` seconds have passed since the oldest
+        collected value arrived, or the end-of-work marker is received. An empty list
+        means that there is nothing left to process."""
+        deadline = None
+
+        if self._pending and self.batch_wait is not None:
+            deadline = time.time() + self.batch_wait
+
+        while not self._finished and len(self._pending) < self.batch_size:
+            timeout = None
+
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+
+            try:
+                batch = self.queue.get(True, timeout)
+            except Empty:
+                break
+
+            if isinstance(batch, _Sentinel):
+                self._finished = True
+                self.ended.value = True
+                break
+
+            if deadline is None and self.batch_wait is not None:
+                deadline = time.time() + self.batch_wait
+
+            self._pending.extend(batch)
+
+        values = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+
+        return values
+
+    def shutdown(self, block=True, timeout=None):
+        """Puts an end-of-work marker on the queue. It is called from the Calculon
+        instance once all of the producers have stopped running, so the marker ends
+        up behind every produced value. Each call stops exactly one consumer: the
+        first one to take the marker from the queue. Raises Full if the queue stays
+        full for timeout seconds."""
+        self.queue.put(_Sentinel(), block, timeout)
 
 
-class ConsumerProcess(_Consumer, Process):
-    """Instantiates _Consumer and Process superclasses."""
-    def __init__(self, func, kwargs, queue, pipe):
-        Process.__init__(self)
-        _Consumer.__init__(self, func, kwargs, queue, pipe)
+class ConsumerProcess(_Consumer, _StartMethodProcess):
+    """Instantiates _Consumer and Process superclasses. If start_method is set, the process is
+    started with that multiprocessing start method (Python 3 only); if cpus is set, the process
+    pins itself to that list of CPUs."""
+    def __init__(self, func, kwargs, queue, pipe, batch_size=None, batch_wait=None, metrics=False, output=None,
+                 start_method=None, cpus=None, cache=None, cache_key=None, cancelled=None, max_retries=None,
+                 retry_delay=0, journal=None, retry=None, profile=False, profile_memory=False, trace_size=None):
+        _StartMethodProcess.__init__(self, start_method)
+        self.cpus = cpus
+        _Consumer.__init__(self, func, kwargs, queue, pipe, batch_size, batch_wait, metrics, output, cache, cache_key,
+                           cancelled, max_retries, retry_delay, journal, retry, profile, profile_memory, trace_size)
 
 
 class ConsumerThread(_Consumer, Thread):
     """Instantiates _Consumer and Thread superclasses."""
-    def __init__(self, func, kwargs, queue):
+    def __init__(self, func, kwargs, queue, batch_size=None, batch_wait=None, metrics=False, output=None,
+                 cache=None, cache_key=None, cancelled=None, max_retries=None, retry_delay=0, profile=False,
+                 trace_size=None):
         Thread.__init__(self)
-        _Consumer.__init__(self, func, kwargs, queue, None)
+        _Consumer.__init__(self, func, kwargs, queue, None, batch_size, batch_wait, metrics, output, cache, cache_key,
+                           cancelled, max_retries, retry_delay, None, None, profile, False, trace_size)
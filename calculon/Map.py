@@ -0,0 +1,105 @@
+"""Implementation of Calculon.map(), Calculon.imap() and Calculon.imap_unordered()."""
+from threading import Event
+
+try:
+    from Queue import Queue as ThreadQueue, Full
+except ImportError:
+    from queue import Queue as ThreadQueue, Full
+
+from .Calculon import Calculon
+
+
+def imap(func, iterable, workers, use_threads, chunksize, max_pending, ordered):
+    """Generator behind Calculon.imap() and Calculon.imap_unordered(), see Calculon.imap()."""
+    # One token per chunk that has been dispatched but not yielded yet: bounds both
+    # the chunks in flight and the reorder buffer.
+    tokens = ThreadQueue(max_pending)
+    cancelled = Event()
+
+    def dispatch():
+        """Waits for a free token, returns False if the map was abandoned meanwhile."""
+        while not cancelled.is_set():
+            try:
+                tokens.put(None, True, 0.1)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def produce(kwargs):
+        """Reads the iterable lazily and yields (chunk number, values) tuples."""
+        number = 0
+        chunk = []
+
+        for value in iterable:
+            chunk.append(value)
+
+            if len(chunk) == chunksize:
+                if not dispatch():
+                    return
+
+                yield number, chunk
+                number += 1
+                chunk = []
+
+        if chunk and dispatch():
+            yield number, chunk
+
+    # The producer runs in a thread of this process, so the iterable is never pickled.
+    calculon = Calculon(produce, [{}], True, _map_consumer, [{"func": func} for i in range(0, workers)],
+                        use_threads, chunk_size=None)
+    stream = calculon.stream(max_pending)
+
+    try:
+        reorder = {}
+        expected = 0
+
+        for number, results, exception in stream:
+            if exception is not None:
+                raise exception
+
+            if not ordered:
+                tokens.get()
+
+                for result in results:
+                    yield result
+
+                continue
+
+            reorder[number] = results
+
+            while expected in reorder:
+                tokens.get()
+
+                for result in reorder.pop(expected):
+                    yield result
+
+                expected += 1
+
+        for res in stream.result["producers"] + stream.result["consumers"]:
+            if "exception" in res:
+                raise res["exception"]
+
+    finally:
+        # Stop reading the input and wait for the chunks in flight, so that no
+        # worker is left blocked if the caller stops early or func raised.
+        cancelled.set()
+
+        for item in stream:
+            pass
+
+
+def _map_consumer(kwargs):
+    """Consumer function that applies func to a chunk of values. Exceptions are returned rather
+    than raised, so that they reach the caller and the consumer keeps running."""
+    if kwargs["_last_call"]:
+        return None
+
+    number, values = kwargs["_value"]
+    func = kwargs["func"]
+
+    try:
+        return number, [func(value) for value in values], None
+    except Exception as e:
+        return number, None, e
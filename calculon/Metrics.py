@@ -0,0 +1,89 @@
+import math
+import time
+from threading import Thread, Event
+
+
+class Histogram:
+    """Latency histogram with fixed power-of-two buckets, from 1 microsecond up to about
+    an hour. Histograms collected in different threads / processes are merged by adding
+    up their buckets."""
+
+    BUCKETS = 33
+
+    def __init__(self):
+        # Bucket i counts durations between 2 ** (i - 1) and 2 ** i microseconds,
+        # the first bucket counts everything under a microsecond.
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Records a duration."""
+        index = math.frexp(seconds * 1000000)[1] if seconds > 0 else 0
+        self.counts[min(max(index, 0), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """Adds the durations recorded by another histogram to this one."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        """Returns the mean duration in seconds."""
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        """Returns the upper bound (in seconds) of the bucket holding the given percentile."""
+        rank = self.count * percent / 100.0
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+
+            if count and seen >= rank:
+                return min(2 ** index / 1000000.0, self.max)
+
+        return self.max
+
+    def __repr__(self):
+        return "<Histogram count={0} mean={1:.6f} p50={2:.6f} p99={3:.6f} max={4:.6f}>".format(
+            self.count, self.mean(), self.percentile(50), self.percentile(99), self.max)
+
+
+class QueueSampler(Thread):
+    """Thread that records the depth of the queue at regular intervals."""
+    def __init__(self, queue, interval):
+        """Initializes the sampler.
+
+        **Keyword arguments**
+
+        * queue -- the queue to sample;
+        * interval -- number of seconds between two samples.
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.interval = interval
+        self.samples = []
+        self.started = time.time()
+        self.stopped = Event()
+
+    def run(self):
+        """Samples the queue until `stop()` is called. Each sample is a (seconds since start, depth) tuple."""
+        while True:
+            self.samples.append((time.time() - self.started, self.queue.qsize()))
+
+            if self.stopped.wait(self.interval):
+                break
+
+    def stop(self):
+        """Stops sampling and waits for the thread to exit."""
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,76 @@
+import zlib
+import struct
+import multiprocessing
+
+try:
+    from Queue import Queue as ThreadQueue
+except ImportError:
+    from queue import Queue as ThreadQueue
+
+
+class PartitionedQueue:
+    """Set of queues, one per consumer, with values routed by key so that all of the values with
+    the same key go to the same consumer."""
+    def __init__(self, partitions, key=None, max_items=0, use_threads=False, context=None):
+        """Initializes the queues. Calculon creates it when `partitioned` is set, producers put values
+        on it and consumer number i gets values from `partition(i)`.
+
+        **Keyword arguments**
+
+        * partitions -- number of queues, i.e. of consumers;
+        * key -- function returning the key of a value; by default, the value itself is the key. Strings, bytes, numbers, None and tuples / frozensets of those are routed the same way in every process, whatever the start method;
+        * max_items -- maximum number of values in each of the queues, 0 for no limit;
+        * use_threads -- a flag specifying if the queues are only used by threads (if False, they can be shared with processes);
+        * context -- multiprocessing context the queues are created with, for process start methods other than the default one.
+        """
+
+        self.key = key
+
+        if use_threads:
+            self.queues = [ThreadQueue(max_items) for i in range(0, partitions)]
+        else:
+            context = context or multiprocessing
+            self.queues = [context.Queue(max_items) for i in range(0, partitions)]
+
+    def put(self, value, block=True, timeout=None):
+        """Puts a value on the queue of the partition its key belongs to."""
+        key = self.key(value) if self.key else value
+        self.queues[_hash(key) % len(self.queues)].put(value, block, timeout)
+
+    def partition(self, index):
+        """Returns the queue of the given partition."""
+        return self.queues[index]
+
+    def qsize(self):
+        """Returns the number of values in all of the queues together."""
+        return sum(queue.qsize() for queue in self.queues)
+
+
+def _hash(key):
+    """Hash of a key that is the same in every process. Python 3 salts the hashes of
+    strings per interpreter, and hashes None by address before Python 3.12, so strings
+    are hashed with CRC32 instead and tuples / frozensets are hashed from the hashes of
+    their items. Numbers use hash(), which is not salted; keys of any other type have to
+    hash the same way in every process (e.g. by defining __hash__ on top of such keys)."""
+    if isinstance(key, bytes):
+        return zlib.crc32(key) & 0xffffffff
+
+    if hasattr(key, "encode"):
+        return zlib.crc32(key.encode("utf-8")) & 0xffffffff
+
+    if key is None:
+        return 0
+
+    if isinstance(key, tuple):
+        value = 0
+
+        for item in key:
+            value = zlib.crc32(struct.pack("<Q", _hash(item) & 0xffffffffffffffff), value) & 0xffffffff
+
+        return value
+
+    # Items of a frozenset come in no particular order.
+    if isinstance(key, frozenset):
+        return sum(_hash(item) for item in key) & 0xffffffff
+
+    return hash(key)
@@ -0,0 +1,192 @@
+try:
+    from Queue import Queue as ThreadQueue, Full
+except ImportError:
+    from queue import Queue as ThreadQueue, Full
+
+from .Consumer import ConsumerProcess, ConsumerThread
+from .Producer import ProducerProcess, ProducerThread, _CANCEL_INTERVAL
+from .StartMethod import check_start_method, get_context
+from .Calculon import _receive, _empty
+
+
+class Pipeline:
+    """Chain of stages: producers feed the consumers of the first stage, and the consumers of every
+    stage feed the consumers of the next one. All of the stages run at the same time."""
+    def __init__(self, prod_func, prod_kwargs, prod_use_threads, max_queue_size=1000, start_method=None, preload=None):
+        """Initializes the pipeline with its producers. Stages are added with `add_stage()`.
+
+        **Keyword arguments**
+
+        * prod_func    -- producer function that accepts one argument (dictionary of values), same as in Calculon;
+        * prod_kwargs  -- a list of dictionaries, each representing a set of arguments for an instance of the producer function;
+        * prod_use_threads -- a flag specifying if threads are used to run producer code (if False, processes are used);
+        * max_queue_size -- the maximum number of values in the queue in front of each stage, 0 for no limit; workers block while the queue of the next stage is full, so intermediate values do not pile up in memory;
+        * start_method, preload -- the multiprocessing start method of the producer / consumer processes and the modules preloaded into the forkserver, same as in Calculon.
+
+        The values of a consumer that fails are left to the other consumers of its stage; once all of them have
+        stopped, the values put in front of the stage are thrown away, so the stages in front of it are not
+        blocked by a full queue.
+        """
+
+        self.prod_func = prod_func
+        self.prod_kwargs = prod_kwargs
+        self.prod_use_threads = prod_use_threads
+        self.max_queue_size = max_queue_size
+
+        # Queues and pipes shared with processes have to come from the context
+        # of the start method the processes are started with.
+        self.start_method = check_start_method(start_method, preload)
+        self.context = get_context(self.start_method)
+
+        self.stages = []
+
+    def add_stage(self, cons_func, cons_kwargs, cons_use_threads):
+        """Appends a stage to the pipeline.
+
+        **Keyword arguments**
+
+        * cons_func    -- consumer function that accepts one argument (dictionary of values), same as in Calculon; every value it returns, except on the last call, is put on the queue of the next stage (`None` is not passed on, so a stage can drop values);
+        * cons_kwargs  -- a list of dictionaries, each representing a set of arguments for an instance of the consumer function;
+        * cons_use_threads -- a flag specifying if threads are used to run consumer code (if False, processes are used).
+
+        **Returns**
+            Returns the pipeline, so that calls can be chained.
+        """
+
+        self.stages.append((cons_func, cons_kwargs, cons_use_threads))
+        return self
+
+    def start(self):
+        """Starts the producers and the workers of every stage and controls the execution. Once the
+        producers stop, the consumers of the first stage are shut down; once those are done, the
+        ones of the second stage are shut down, and so on, so the end of the stream travels from
+        stage to stage behind the values.
+
+        **Keyword arguments**
+
+            None
+
+        **Returns**
+            Returns a dictionary containing two elements:
+
+            * value for key "producers" contains a list of results returned by each of the producer instance.
+            * value for key "stages" contains a list with an element for every stage, the list of results returned by each of its consumer instances.
+        """
+
+        if not self.stages:
+            raise ValueError("pipeline has no stages")
+
+        # The queue in front of every stage; values only pass by reference
+        # if both sides of a queue are threads.
+        use_threads = [self.prod_use_threads] + [stage[2] for stage in self.stages]
+        queues = []
+
+        for id in range(0, len(self.stages)):
+            if use_threads[id] and use_threads[id + 1]:
+                queues.append(ThreadQueue(self.max_queue_size))
+            else:
+                queues.append(self.context.Queue(self.max_queue_size))
+
+        # Producers.
+        prod_objs = []
+        prod_pipes = []
+
+        for args in self.prod_kwargs:
+            if self.prod_use_threads:
+                prod_pipes.append(None)
+                prod_obj = ProducerThread(self.prod_func, args, queues[0],
+                                          stall_timing=bool(self.max_queue_size))
+            else:
+                prod_pipes.append(self.context.Pipe())
+                prod_obj = ProducerProcess(self.prod_func, args, queues[0], prod_pipes[-1][0],
+                                           stall_timing=bool(self.max_queue_size), start_method=self.start_method)
+
+            prod_objs.append(prod_obj)
+            prod_obj.start()
+
+        # Consumers of every stage, the last stage has nowhere to put its values.
+        stage_objs = []
+        stage_pipes = []
+
+        for id, (cons_func, cons_kwargs, cons_use_threads) in enumerate(self.stages):
+            output = queues[id + 1] if id + 1 < len(queues) else None
+            cons_objs = []
+            cons_pipes = []
+
+            for args in cons_kwargs:
+                if cons_use_threads:
+                    cons_pipes.append(None)
+                    cons_obj = ConsumerThread(cons_func, args, queues[id], output=output)
+                else:
+                    cons_pipes.append(self.context.Pipe())
+                    cons_obj = ConsumerProcess(cons_func, args, queues[id], cons_pipes[-1][0], output=output,
+                                               start_method=self.start_method)
+
+                cons_objs.append(cons_obj)
+                cons_obj.start()
+
+            stage_objs.append(cons_objs)
+            stage_pipes.append(cons_pipes)
+
+        # Join on the producers, then shut down and join the stages one after another.
+        workers = [prod_objs] + stage_objs
+
+        _wait(prod_objs, workers, queues)
+
+        for prod_obj in prod_objs:
+            prod_obj.join()
+
+        for cons_objs in stage_objs:
+            _wait(cons_objs, workers, queues, cons_objs)
+
+            for cons_obj in cons_objs:
+                cons_obj.join()
+
+        # Collect result values.
+        result = {"producers": [_result(obj, pipe) for obj, pipe in zip(prod_objs, prod_pipes)],
+                  "stages": []}
+
+        for cons_objs, cons_pipes in zip(stage_objs, stage_pipes):
+            result["stages"].append([_result(obj, pipe) for obj, pipe in zip(cons_objs, cons_pipes)])
+
+        return result
+
+
+def _wait(objs, workers, queues, shutdown=()):
+    """Waits for the threads / processes to finish, throwing away the values in front of every stage whose
+    consumers have all stopped, so that the stage in front of it is not left blocked on a full queue;
+    workers is the list of the producers and of the consumers of every stage, queues[i] is fed by
+    workers[i] and read by workers[i + 1]. The
+    consumers in shutdown get an end-of-work marker each, unless they stopped early, lest the markers fill
+    a queue nobody takes values from. A consumer that stopped after taking a marker still counts,
+    as the marker it took may have been put for another one."""
+    pending = list(shutdown)
+
+    while True:
+        running = [obj for obj in objs if obj.is_alive()]
+
+        for id, queue in enumerate(queues):
+            if not any(obj.is_alive() for obj in workers[id + 1]) and any(obj.is_alive() for obj in workers[id]):
+                _empty(queue, True)
+
+        while pending:
+            if not pending[0].is_alive() and not pending[0].ended.value:
+                pending.pop(0)
+                continue
+
+            try:
+                pending[0].shutdown(True, _CANCEL_INTERVAL)
+            except Full:
+                break
+
+            pending.pop(0)
+
+        if not running:
+            break
+
+        running[0].join(_CANCEL_INTERVAL)
+
+
+def _result(obj, pipe):
+    """Returns the result of a producer / consumer, received through its pipe if it ran in a process."""
+    return _receive(pipe[1], obj) if pipe else obj.result
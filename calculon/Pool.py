@@ -0,0 +1,318 @@
+import time
+from threading import Thread, Lock
+from multiprocessing import Process, Queue, Pipe, Lock as ProcessLock
+
+try:
+    from Queue import Queue as ThreadQueue, Empty
+except ImportError:
+    from queue import Queue as ThreadQueue, Empty
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .Consumer import _Consumer, _Sentinel
+from .Producer import _Producer, _CANCEL_INTERVAL
+from .Calculon import _died
+
+
+class _ProducerDone:
+    """Marker a pool worker puts on the queue behind the values of a producer it finished
+    running. Once a consumer takes it off the queue, every value of that producer has been
+    taken too. Processes that stay up do not flush their queue buffers on exit, so this is
+    how the pool knows when it is safe to shut down the consumers."""
+    def __init__(self, run):
+        self.run = run
+
+
+class _ResultQueue:
+    """Queue process workers put their results on. Unlike a multiprocessing queue, which pickles
+    and writes from a background thread, `put()` is done once it returns: a result that cannot be
+    pickled raises there, and one that was put is not lost if the worker dies afterwards."""
+    def __init__(self):
+        self.reader, self.writer = Pipe(False)
+        self.lock = ProcessLock()
+
+    def put(self, item):
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+
+        with self.lock:
+            self.writer.send_bytes(data)
+
+    def get(self, block=True, timeout=None):
+        if not self.reader.poll(timeout if block else 0):
+            raise Empty
+
+        return pickle.loads(self.reader.recv_bytes())
+
+
+class _PoolSentinel(_Sentinel):
+    """End-of-work marker of a run. A consumer that dies leaves its marker on the queue,
+    consumers of the next runs skip it."""
+    def __init__(self, run):
+        self.run = run
+
+
+class _PoolQueue:
+    """Queue handed to consumers run by a pool worker. Reports producer markers to the pool
+    instead of returning them."""
+    def __init__(self, queue, results, run):
+        self.queue = queue
+        self.results = results
+        self.run = run
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+
+            value = self.queue.get(block, timeout)
+
+            if isinstance(value, _PoolSentinel) and value.run != self.run:
+                continue
+
+            if not isinstance(value, _ProducerDone):
+                return value
+
+            self.results.put(((value.run, "drained", None), None))
+
+    def put(self, value, block=True, timeout=None):
+        self.queue.put(value, block, timeout)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class _PoolPipe:
+    """Stands in for the Pipe end of a producer / consumer run by a pool worker,
+    sends the result to the pool tagged with the job it belongs to."""
+    def __init__(self, results, job):
+        self.results = results
+        self.job = job
+
+    def send(self, result):
+        try:
+            self.results.put((self.job, result))
+        except Exception as e:
+            # Only the results of process workers get pickled.
+            error = RuntimeError("result of {0} could not be pickled: {1}".format(result["name"], e))
+            self.results.put((self.job, {"name": result["name"], "exception": error}))
+
+    def close(self):
+        pass
+
+
+class _PoolWorker:
+    """Pool worker class."""
+    def __init__(self, tasks, queue, results):
+        """Pool worker superclass, contains all of the functionality. WorkerPool instantiates
+        PoolWorkerThread or PoolWorkerProcess that inherit from _PoolWorker and from either
+        Thread or Process classes.
+
+        **Keyword arguments**
+
+        * tasks -- queue of jobs to run, `None` tells the worker to exit;
+        * queue -- the queue shared by producers and consumers;
+        * results -- queue where the result of every job is put.
+        """
+
+        self.tasks = tasks
+        self.queue = queue
+        self.results = results
+
+    def run(self):
+        """Runs producer and consumer jobs one after another until told to exit. Each job is
+        a fresh _Producer or _Consumer, so nothing is carried over from one job to the next."""
+        while True:
+            task = self.tasks.get()
+
+            if task is None:
+                break
+
+            job, func, kwargs, batch_size, batch_wait = task
+            run, key, id = job
+
+            # Lets the pool know whose result is lost if this worker dies.
+            self.results.put(((run, "started", (key, id)), self.name))
+
+            pipe = _PoolPipe(self.results, job)
+
+            if key == "producers":
+                worker = _Producer(func, kwargs, self.queue, pipe, batch_size, batch_wait)
+                worker.run()
+
+                self.queue.put(_ProducerDone(run))
+            else:
+                queue = _PoolQueue(self.queue, self.results, run)
+                worker = _Consumer(func, kwargs, queue, pipe, batch_size, batch_wait)
+                worker.run()
+
+
+class PoolWorkerProcess(_PoolWorker, Process):
+    """Instantiates _PoolWorker and Process superclasses."""
+    def __init__(self, tasks, queue, results):
+        Process.__init__(self)
+        _PoolWorker.__init__(self, tasks, queue, results)
+
+
+class PoolWorkerThread(_PoolWorker, Thread):
+    """Instantiates _PoolWorker and Thread superclasses."""
+    def __init__(self, tasks, queue, results):
+        Thread.__init__(self)
+        _PoolWorker.__init__(self, tasks, queue, results)
+
+
+class WorkerPool:
+    """Long-lived set of workers that run producers and consumers for many Calculon runs."""
+    def __init__(self, workers, use_threads=False):
+        """Starts the workers. They stay up until `close()` is called, so that the cost of
+        starting processes (and of importing modules in them) is paid once rather than on
+        every run.
+
+        **Keyword arguments**
+
+        * workers -- number of workers; a run can have more producers and consumers than that, but then consumers only start once producers finish and free a worker;
+        * use_threads -- a flag specifying if workers are threads (if False, processes are used).
+        """
+
+        self.use_threads = use_threads
+
+        if use_threads:
+            self.tasks, self.queue, self.results = ThreadQueue(), ThreadQueue(), ThreadQueue()
+        else:
+            self.tasks, self.queue, self.results = Queue(), Queue(), _ResultQueue()
+
+        self.workers = [self._start_worker() for i in range(0, workers)]
+
+        # Runs share the queues, so they go one at a time.
+        self.lock = Lock()
+        self.runs = 0
+
+    def submit_run(self, prod_func, prod_kwargs, cons_func, cons_kwargs, batch_size=None, batch_wait=None):
+        """Dispatches producers and consumers to the workers and waits for them to finish.
+
+        **Keyword arguments**
+
+            Same as the producer / consumer arguments of Calculon. With process workers, the
+            functions and their arguments are pickled, so the functions have to be defined
+            at the top level of a module. A worker process that dies is replaced; the producer /
+            consumer it was running gets a RuntimeError as its exception, and so does one whose
+            result cannot be pickled.
+
+        **Returns**
+            Returns the same dictionary as Calculon.start(), containing only the results of this run.
+        """
+
+        with self.lock:
+            self.runs += 1
+            run = self.runs
+
+            result = {"producers": [None] * len(prod_kwargs),
+                      "consumers": [None] * len(cons_kwargs)}
+
+            # Producers go first, so that they get the workers before consumers do.
+            for id in range(0, len(prod_kwargs)):
+                self.tasks.put(((run, "producers", id), prod_func, prod_kwargs[id], batch_size, batch_wait))
+
+            for id in range(0, len(cons_kwargs)):
+                self.tasks.put(((run, "consumers", id), cons_func, cons_kwargs[id], batch_size, batch_wait))
+
+            remaining = len(prod_kwargs) + len(cons_kwargs)
+            done = {"producers": 0, "consumers": 0, "drained": 0}
+            shutdown = False
+            # Jobs of this run being run, by the name of their worker.
+            running = {}
+            dead = []
+
+            while True:
+                # Shut down the consumers once all of the producers are done and all of their values
+                # have been taken off the queue, or once there are no consumers left to take them.
+                if not shutdown and done["producers"] == len(prod_kwargs) and \
+                        (done["drained"] == len(prod_kwargs) or done["consumers"] == len(cons_kwargs)):
+                    for i in range(0, len(cons_kwargs) - done["consumers"]):
+                        self.queue.put(_PoolSentinel(run))
+
+                    shutdown = True
+
+                if not remaining:
+                    break
+
+                try:
+                    (job_run, key, id), res = self.results.get(True, _CANCEL_INTERVAL)
+                except Empty:
+                    # Whatever these workers put before they died has been taken off by now.
+                    for worker in dead:
+                        if worker.name not in running:
+                            continue
+
+                        key, id = running.pop(worker.name)
+                        result[key][id] = {"name": worker.name, "exception": _died(worker)}
+                        remaining -= 1
+                        done[key] += 1
+
+                        # Its values are gone along with it, and so is its marker.
+                        if key == "producers":
+                            done["drained"] += 1
+
+                    dead = self._respawn()
+                    continue
+
+                # Markers left over from a previous run.
+                if job_run != run:
+                    continue
+
+                if key == "started":
+                    running[res] = id
+                    continue
+
+                done[key] += 1
+
+                if key != "drained":
+                    running = dict((name, job) for name, job in running.items() if job != (key, id))
+                    result[key][id] = res
+                    remaining -= 1
+
+            # If the consumers stopped before taking every value, what is left on the queue would
+            # go to the consumers of the next run; throw it away, up to the markers of this run.
+            while done["drained"] < len(prod_kwargs):
+                value = self.queue.get()
+
+                if isinstance(value, _ProducerDone) and value.run == run:
+                    done["drained"] += 1
+
+            if batch_size:
+                result["batch_size"] = batch_size
+
+            return result
+
+    def _start_worker(self):
+        if self.use_threads:
+            worker = PoolWorkerThread(self.tasks, self.queue, self.results)
+        else:
+            worker = PoolWorkerProcess(self.tasks, self.queue, self.results)
+
+        worker.daemon = True
+        worker.start()
+
+        return worker
+
+    def _respawn(self):
+        """Replaces the workers that died, returns them."""
+        dead = []
+
+        for i, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                dead.append(worker)
+                self.workers[i] = self._start_worker()
+
+        return dead
+
+    def close(self):
+        """Stops the workers and waits for them to exit."""
+        for worker in self.workers:
+            self.tasks.put(None)
+
+        for worker in self.workers:
+            worker.join()
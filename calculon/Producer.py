@@ -1,12 +1,177 @@
+import time
 import uuid
+import inspect
 import logging
 from threading import Thread
-from multiprocessing import Process
+
+try:
+    from Queue import Full
+except ImportError:
+    from queue import Full
+
+from .StartMethod import _StartMethodProcess
+from .Affinity import pin
+from .Profile import _WorkerProfile
+from .Trace import SpanBuffer
+
+
+# How often a producer blocked on a full queue checks if the run has been cancelled.
+_CANCEL_INTERVAL = 0.05
+
+
+class Cancelled(Exception):
+    """Raised by `put()` of the producer queue once the run has been cancelled."""
+    pass
+
+
+class _Chunk(list):
+    """Values of a generator producer sent in one transfer when batching is not enabled.
+    Consumers unpack it and call the consumer function once per value, as if the values
+    had been put on the queue one by one."""
+    pass
+
+
+class _BatchingQueue:
+    """Producer-side handle that coalesces values into lists before putting them on the
+    queue, so that a whole batch costs one pickle and one pipe write."""
+    def __init__(self, queue, batch_size, batch_wait=None, batch_type=list):
+        """Initializes the handle.
+
+        **Keyword arguments**
+
+        * queue -- the queue batches are put on;
+        * batch_size -- maximum number of values in a batch;
+        * batch_wait -- if set, a batch is also sent on `put()` once its oldest value has waited this many seconds;
+        * batch_type -- list type the batches are made of.
+        """
+
+        self.queue = queue
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.batch_type = batch_type
+        self.buffer = batch_type()
+        self.started = None
+
+    def put(self, value):
+        """Buffers a value, sending the batch once it is full or too old."""
+        if not self.buffer:
+            self.started = time.time()
+
+        self.buffer.append(value)
+
+        if len(self.buffer) >= self.batch_size or \
+                (self.batch_wait is not None and time.time() - self.started >= self.batch_wait):
+            self.flush()
+
+    def put_many(self, values):
+        """Buffers a sequence of values, sending full batches as they fill up."""
+        for value in values:
+            self.put(value)
+
+    def flush(self):
+        """Sends whatever is buffered as a (possibly short) batch."""
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.buffer = self.batch_type()
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class _StallTimer:
+    """Producer-side handle that measures how long the producer spends blocked on a full queue,
+    recording every stall as a span if tracing."""
+    def __init__(self, queue, spans=None):
+        self.queue = queue
+        self.spans = spans
+        self.stalled = 0.0
+
+    def put(self, value, block=True, timeout=None):
+        """Puts a value on the queue. Only a put that cannot go through right away is timed."""
+        try:
+            self.queue.put(value, False)
+        except Full:
+            if not block:
+                raise
+
+            started = time.time()
+
+            try:
+                self.queue.put(value, True, timeout)
+            finally:
+                self.stalled += time.time() - started
+
+                if self.spans is not None:
+                    self.spans.add("queue.put", started)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class _CancellableQueue:
+    """Producer-side handle that raises Cancelled once the run has been cancelled, including while
+    the producer is blocked on a full queue."""
+    def __init__(self, queue, cancelled):
+        self.queue = queue
+        self.cancelled = cancelled
+
+    def put(self, value, block=True, timeout=None):
+        """Puts a value on the queue, waiting in short steps while it is full so that cancellation
+        is noticed."""
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+        if not block:
+            self.queue.put(value, False)
+            return
+
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while True:
+            wait = _CANCEL_INTERVAL if deadline is None else max(min(_CANCEL_INTERVAL, deadline - time.time()), 0)
+
+            try:
+                self.queue.put(value, True, wait)
+                return
+            except Full:
+                if self.cancelled.is_set():
+                    raise Cancelled()
+
+                if deadline is not None and time.time() >= deadline:
+                    raise
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class _CountingQueue:
+    """Producer-side handle that counts the values put on the queue."""
+    def __init__(self, queue):
+        self.queue = queue
+        self.count = 0
+
+    def put(self, value, *args, **kwargs):
+        self.count += len(value) if isinstance(value, _Chunk) else 1
+        self.queue.put(value, *args, **kwargs)
+
+    def put_many(self, values):
+        self.queue.put_many(self._counted(values))
+
+    def _counted(self, values):
+        for value in values:
+            self.count += 1
+            yield value
+
+    def __getattr__(self, name):
+        return getattr(self.queue, name)
+
 
 class _Producer:
 
     """Producer class."""
-    def __init__(self, func, kwargs, queue, pipe):
+    def __init__(self, func, kwargs, queue, pipe, batch_size=None, batch_wait=None, stall_timing=False,
+                 metrics=False, chunk_size=None, cancelled=None, profile=False, profile_memory=False,
+                 trace_size=None):
         """Producer superclass, contains all of the functionality. Calculon does not deal with this
         class directly, rather it instantiates ProducerThread or ProducerProcess that inherit from
         _Producer and from either Thread or Process classes.
@@ -16,7 +181,16 @@ class _Producer:
         * queue -- instance of multiprocessing.Queue;
         * func -- function that puts values into the queue, optional return value;
         * kwargs -- a dictionary of arguments passed to func;
-        * pipe -- end of a multiprocessing.Pipe() to which producer can write the results.
+        * pipe -- end of a multiprocessing.Pipe() to which producer can write the results;
+        * batch_size -- if set, values are put on the queue in lists of up to this many values;
+        * batch_wait -- if set along with batch_size, a partial batch is sent once its oldest value is this many seconds old;
+        * stall_timing -- a flag specifying if the time spent waiting on a full queue is measured and reported;
+        * metrics -- a flag specifying if the producer keeps track of the values it puts and of its running time;
+        * chunk_size -- if set and batching is not enabled, values of a generator producer are put on the queue in chunks of up to this many values (see `run()`);
+        * cancelled -- if set, an Event that is set once the run is cancelled; from then on, putting a value on the queue raises Cancelled;
+        * profile -- a flag specifying if `run()` is profiled with cProfile;
+        * profile_memory -- a flag specifying if the peak memory use of a producer process is traced with tracemalloc while profiling;
+        * trace_size -- if set, the producer records timed spans in a ring buffer of this many spans (see `run()`).
         """
 
         self.name = uuid.uuid1().hex
@@ -24,6 +198,15 @@ class _Producer:
         self.kwargs = kwargs if kwargs else {}
         self.queue = queue
         self.pipe = pipe
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.stall_timing = stall_timing
+        self.metrics = metrics
+        self.chunk_size = chunk_size
+        self.cancelled = cancelled
+        self.profile = profile
+        self.profile_memory = profile_memory
+        self.trace_size = trace_size
 
     def run(self):
         """Runs the producer function once.
@@ -35,7 +218,17 @@ class _Producer:
         When the producer function is called, two additional arguments are passed to it:
 
         * _name -- unique name of the producer (uuid);
-        * _queue -- the queue object where to put the results;.
+        * _queue -- the queue object where to put the results. If batching is enabled, this is a buffered handle that also offers `put_many(values)` and `flush()`; whatever is left in the buffer is sent once the producer function returns.
+
+        If the run can be cancelled, a third one is passed as well:
+
+        * _cancelled -- an Event that is set once the run is cancelled; a producer can check it with `is_set()`, or just keep putting values on the queue, which raises Cancelled once the event is set.
+
+        The producer function can also be a generator function, in which case the values it yields are put
+        on the queue for it (blocking while the queue is full) and the generator's return value becomes the
+        result. With batching, the values go into batches as usual; otherwise they are sent in chunks of up
+        to `chunk_size` values, to save on per-value queue overhead. Other return values, including lists,
+        are never put on the queue.
 
         **Returns**
 
@@ -44,46 +237,185 @@ class _Producer:
             * "name" -- name of this producer (uuid);
             * "result" -- the return value returned from the producer function.
 
+        * If the producer function is a generator function, the dictionary also contains:
+
+            * "items" -- number of values the generator yielded.
+
+        * If stall timing is enabled, the dictionary also contains:
+
+            * "stalled" -- number of seconds the producer spent blocked because the queue was full.
+
+        * If metrics are enabled, the dictionary also contains:
+
+            * "metrics" -- a dictionary with the name of the producer, the number of values it put on the queue ("items") and the number of seconds the producer function ran ("busy").
+
+        * If the run was cancelled while the producer was putting a value on the queue, the method returns a dictionary with three keys:
+
+            * "name" -- name of this producer (uuid);
+            * "result" -- None;
+            * "cancelled" -- True.
+
         * If the run completed unsuccessfully, the method returns a dictionary with two keys:
 
             * "name" -- name of this producer (uuid);
             * "exception" -- the exception object for the raised exception.
+
+        * If the producer runs in a process, the dictionary also contains (in either case):
+
+            * "startup" -- number of seconds between the start of the process and the start of this method;
+            * "cpus" -- the list of CPUs the process is pinned to, if CPU affinity is set.
+
+        * If profiling is enabled, the dictionary also contains (in either case):
+
+            * "profile" -- a dictionary with the cProfile stats of this method ("stats", picklable and loadable by pstats.Stats) and, if memory is traced, the peak number of bytes allocated by the process ("peak").
+
+        * If tracing is enabled, the dictionary also contains (in either case):
+
+            * "trace" -- the spans recorded by the producer (see SpanBuffer.export): "startup" (process only), "run" for this method, "prod_func" for the producer function (including putting the values of a generator producer on the queue) and "queue.put" for every time it was blocked on a full queue.
         """
+        start_time = getattr(self, "start_time", None)
+        startup = time.time() - start_time if start_time is not None else None
+
+        profile = _WorkerProfile(self.profile_memory, self.pipe is not None) if self.profile else None
+
+        spans = SpanBuffer(self.trace_size) if self.trace_size else None
+        run_started = time.time()
+
+        if spans is not None and start_time is not None:
+            spans.add("startup", start_time, run_started)
+
         # Add two additional arguments.
         self.kwargs["_name"] = self.name
-        self.kwargs["_queue"] = self.queue
+
+        queue = self.queue
+
+        if self.cancelled is not None:
+            queue = _CancellableQueue(queue, self.cancelled)
+            self.kwargs["_cancelled"] = self.cancelled
+
+        if self.stall_timing or spans is not None:
+            queue = timer = _StallTimer(queue, spans)
+
+        if self.batch_size:
+            queue = _BatchingQueue(queue, self.batch_size, self.batch_wait)
+
+        if self.metrics:
+            queue = counter = _CountingQueue(queue)
+            started = time.time()
+
+        self.kwargs["_queue"] = queue
+
+        cpus = getattr(self, "cpus", None)
 
         try:
-            self._result = self.func(self.kwargs)
+            pin(cpus)
+
+            try:
+                func_started = time.time()
+                self._result = self.func(self.kwargs)
+
+                if inspect.isgenerator(self._result):
+                    items, self._result = self._drain(self._result)
+                else:
+                    items = None
+            finally:
+                if spans is not None:
+                    spans.add("prod_func", func_started)
+
+                if self.batch_size:
+                    self.kwargs["_queue"].flush()
 
             # Set result dictionary.
             self.result = {
                 'name': self.name,
                 'result': self._result
             }
+
+            if items is not None:
+                self.result['items'] = items
+        except Cancelled:
+            self.result = {
+                'name': self.name,
+                'result': None,
+                'cancelled': True
+            }
         except Exception as e:
             self.result = {
                 'name': self.name,
                 'exception': e
             }
 
+        if startup is not None:
+            self.result['startup'] = startup
+
+        if cpus is not None:
+            self.result['cpus'] = cpus
+
+        if self.stall_timing:
+            self.result['stalled'] = timer.stalled
+
+        if self.metrics:
+            self.result['metrics'] = {
+                'name': self.name,
+                'items': counter.count,
+                'busy': time.time() - started
+            }
+
+        if profile is not None:
+            self.result['profile'] = profile.stop()
+
+        if spans is not None:
+            spans.add("run", run_started)
+            self.result['trace'] = spans.export()
+
         # For multiprocessing we need to communicate results through a pipe.
         if self.pipe:
             self.pipe.send(self.result)
             self.pipe.close()
 
+    def _drain(self, generator):
+        """Puts the values yielded by a generator producer on the queue. Returns the number
+        of values and the return value of the generator (always None on Python 2)."""
+        queue = self.kwargs["_queue"]
+
+        if not self.batch_size and self.chunk_size and self.chunk_size > 1:
+            queue = _BatchingQueue(queue, self.chunk_size, batch_type=_Chunk)
+
+        items = 0
+
+        try:
+            while True:
+                try:
+                    value = next(generator)
+                except StopIteration as e:
+                    return items, getattr(e, "value", None)
+
+                queue.put(value)
+                items += 1
+        finally:
+            if queue is not self.kwargs["_queue"]:
+                queue.flush()
+
 
-class ProducerProcess(_Producer, Process):
+class ProducerProcess(_Producer, _StartMethodProcess):
     """Process-based producer class."""
-    def __init__(self, func, kwargs, queue, pipe):
-        """Instantiates _Producer and Process superclasses."""
-        Process.__init__(self)
-        _Producer.__init__(self, func, kwargs, queue, pipe)
+    def __init__(self, func, kwargs, queue, pipe, batch_size=None, batch_wait=None, stall_timing=False,
+                 metrics=False, chunk_size=None, start_method=None, cpus=None, cancelled=None, profile=False,
+                 profile_memory=False, trace_size=None):
+        """Instantiates _Producer and Process superclasses. If start_method is set, the process is
+        started with that multiprocessing start method (Python 3 only); if cpus is set, the process
+        pins itself to that list of CPUs."""
+        _StartMethodProcess.__init__(self, start_method)
+        self.cpus = cpus
+        _Producer.__init__(self, func, kwargs, queue, pipe, batch_size, batch_wait, stall_timing, metrics,
+                           chunk_size, cancelled, profile, profile_memory, trace_size)
 
 
 class ProducerThread(_Producer, Thread):
     """Thread-based producer class."""
-    def __init__(self, func, kwargs, queue):
+    def __init__(self, func, kwargs, queue, batch_size=None, batch_wait=None, stall_timing=False,
+                 metrics=False, chunk_size=None, cancelled=None, profile=False, trace_size=None):
         """Instantiates _Producer and Thread superclasses."""
         Thread.__init__(self)
-        _Producer.__init__(self, func, kwargs, queue, None)
+        _Producer.__init__(self, func, kwargs, queue, None, batch_size, batch_wait, stall_timing, metrics,
+                           chunk_size, cancelled, profile, False, trace_size)
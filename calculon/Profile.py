@@ -0,0 +1,110 @@
+import pstats
+import cProfile
+import warnings
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class _WorkerProfile:
+    """cProfile (and tracemalloc) capture of one producer / consumer, from the start of its `run()`
+    until its result is ready."""
+    def __init__(self, memory, in_process):
+        """Starts profiling the calling thread.
+
+        **Keyword arguments**
+
+        * memory -- a flag specifying if the peak memory use is traced as well; tracemalloc needs Python 3.4 or newer, and traces the whole process, so it is only used in producer / consumer processes;
+        * in_process -- a flag specifying if the worker runs in a process of its own.
+        """
+
+        self.memory = memory and in_process and tracemalloc is not None
+
+        if self.memory:
+            # A forked process inherits the tracing of its parent.
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+            tracemalloc.start()
+
+        self.profiler = cProfile.Profile()
+
+        try:
+            self.profiler.enable()
+        except ValueError as e:
+            # Python 3.12 and newer only allow one profiler at a time.
+            warnings.warn("worker not profiled: {0}".format(e), RuntimeWarning)
+            self.profiler = None
+
+    def stop(self):
+        """Stops profiling and returns a dictionary with the stats ("stats", None if the worker could not be
+        profiled) and, if memory is traced, the peak number of bytes allocated ("peak")."""
+        result = {"stats": None}
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.create_stats()
+            result["stats"] = _Stats(self.profiler.stats)
+
+        if self.memory:
+            result["peak"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        return result
+
+
+class _Stats:
+    """Picklable stats of a profiler, which pstats.Stats can load like a profiler."""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def merge_stats(stats, path=None):
+    """Merges the stats of several workers into one pstats.Stats object, written to path if given.
+    Returns None if there are no stats."""
+    stats = [item for item in stats if item is not None]
+
+    if not stats:
+        return None
+
+    merged = pstats.Stats(stats[0])
+
+    for item in stats[1:]:
+        merged.add(item)
+
+    if path is not None:
+        merged.dump_stats(path)
+
+    return merged
+
+
+def start_tracing():
+    """Starts tracing memory allocations of this process, for thread workers. Returns False if tracemalloc is not
+    available or memory is traced already."""
+    if tracemalloc is None or tracemalloc.is_tracing():
+        return False
+
+    tracemalloc.start()
+    return True
+
+
+def stop_tracing():
+    """Stops tracing memory allocations of this process, returns the peak number of bytes allocated."""
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def check_memory_profiling(profile_memory):
+    """Returns profile_memory, or False with a warning if tracemalloc is not available."""
+    if profile_memory and tracemalloc is None:
+        warnings.warn("memory profiling requires tracemalloc (Python 3.4 or newer), peak memory is not traced",
+                      RuntimeWarning)
+        return False
+
+    return profile_memory
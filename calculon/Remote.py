@@ -0,0 +1,237 @@
+"""Distributed mode: the queue of a Calculon instance is served over TCP and consumers run on
+other nodes, started with
+
+    $ python -m calculon.Remote --address host:port --authkey secret --consumers 4
+
+The functions and their arguments are pickled, so the consumer function has to be importable
+on every node under the same module name."""
+import sys
+import time
+import socket
+import argparse
+import threading
+from multiprocessing import Queue, Pipe
+from multiprocessing.managers import BaseManager
+
+try:
+    from Queue import Queue as ThreadQueue, Empty, Full
+except ImportError:
+    from queue import Queue as ThreadQueue, Empty, Full
+
+from .Consumer import ConsumerProcess, ConsumerThread, _Sentinel
+from .Producer import _CANCEL_INTERVAL
+
+
+class _Coordinator:
+    """Object served to the nodes: hands out consumer slots, values and collects results."""
+    def __init__(self, queue, cons_func, cons_kwargs, batch_size, batch_wait):
+        self.queue = queue
+        self.cons_func = cons_func
+        self.cons_kwargs = cons_kwargs
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self.free = list(range(0, len(cons_kwargs)))
+        self.lock = threading.Lock()
+        self.results = ThreadQueue()
+
+    def config(self):
+        """Returns the consumer function and the batching options of the run."""
+        return self.cons_func, self.batch_size, self.batch_wait
+
+    def register(self, count):
+        """Assigns up to count consumer slots to a node, returns a list of (slot, kwargs) tuples."""
+        with self.lock:
+            slots, self.free = self.free[:count], self.free[count:]
+
+        return [(slot, self.cons_kwargs[slot]) for slot in slots]
+
+    def get_many(self, count):
+        """Blocks until a value is available and returns a list of up to count values. The list ends
+        early with an end-of-work marker, so that a node never takes markers meant for other nodes."""
+        values = [self.queue.get()]
+
+        while len(values) < count and not isinstance(values[-1], _Sentinel):
+            try:
+                values.append(self.queue.get(False))
+            except Empty:
+                break
+
+        return values
+
+    def report(self, slot, result):
+        """Receives the result of the consumer of a slot."""
+        self.results.put((slot, result))
+
+
+class _NodeManager(BaseManager):
+    """Client side of the coordinator."""
+    pass
+
+
+_NodeManager.register("coordinator")
+
+
+class QueueServer:
+    """TCP server that makes the queue of a Calculon run available to remote nodes."""
+    def __init__(self, address, authkey, queue, cons_func, cons_kwargs, batch_size=None, batch_wait=None):
+        """Starts listening. Calculon creates the server in `start()` when `remote_address` is given.
+
+        **Keyword arguments**
+
+        * address -- (host, port) tuple to listen on;
+        * authkey -- key (bytes) nodes have to present to connect;
+        * queue -- the queue producers put values on;
+        * cons_func, cons_kwargs -- the consumer function and the list of its arguments, one dictionary per consumer slot;
+        * batch_size, batch_wait -- batching options, same as in Calculon.
+        """
+
+        self.coordinator = _Coordinator(queue, cons_func, cons_kwargs, batch_size, batch_wait)
+
+        # Every server gets its own registry, so that several runs can be served at once.
+        class _ServerManager(BaseManager):
+            pass
+
+        _ServerManager.register("coordinator", callable=lambda: self.coordinator)
+
+        self.server = _ServerManager(address, authkey).get_server()
+        self.address = self.server.address
+        self.stopped = False
+
+        # Set up by serve_forever() on Python 3, which would take over this thread;
+        # connections are served until it is set.
+        self.server.stop_event = threading.Event()
+
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def results(self, count):
+        """Waits for count consumer results, returns them ordered by slot."""
+        results = [None] * count
+
+        for i in range(0, count):
+            slot, result = self.coordinator.results.get()
+            results[slot] = result
+
+        return results
+
+    def close(self):
+        """Stops accepting connections."""
+        self.stopped = True
+        self.server.stop_event.set()
+
+        # Wake the accepting thread up.
+        socket.create_connection(self.address).close()
+        self.thread.join()
+        self.server.listener.close()
+
+    def _accept(self):
+        while True:
+            connection = self.server.listener.accept()
+
+            if self.stopped:
+                connection.close()
+                break
+
+            thread = threading.Thread(target=self.server.handle_request, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+
+def run_node(address, authkey, consumers=1, use_threads=False, node_batch=100, connect_timeout=30):
+    """Connects to a Calculon run in distributed mode and runs consumers for it until the run is over.
+
+    Values are fetched from the server up to `node_batch` at a time and handed to the local consumers
+    through a local queue, so that a round trip to the server is shared by many values.
+
+    **Keyword arguments**
+
+    * address -- (host, port) tuple of the server;
+    * authkey -- the key given to the server;
+    * consumers -- the number of consumers to run on this node; fewer are run if the server has fewer consumer slots left;
+    * use_threads -- a flag specifying if threads are used to run consumer code (if False, processes are used);
+    * node_batch -- the maximum number of values fetched from the server at once;
+    * connect_timeout -- number of seconds to keep trying to connect while the server is not up yet.
+
+    **Returns**
+        Returns the number of consumers run on this node.
+    """
+
+    manager = _NodeManager(address, authkey)
+    deadline = time.time() + connect_timeout
+
+    while True:
+        try:
+            manager.connect()
+            break
+        except (IOError, OSError):
+            if time.time() > deadline:
+                raise
+
+            time.sleep(0.1)
+
+    coordinator = manager.coordinator()
+    cons_func, batch_size, batch_wait = coordinator.config()
+    slots = coordinator.register(consumers)
+
+    local = ThreadQueue(node_batch) if use_threads else Queue(node_batch)
+    cons_objs = []
+    cons_pipes = []
+
+    for slot, args in slots:
+        if use_threads:
+            cons_pipes.append(None)
+            cons_obj = ConsumerThread(cons_func, args, local, batch_size, batch_wait)
+        else:
+            cons_pipes.append(Pipe())
+            cons_obj = ConsumerProcess(cons_func, args, local, cons_pipes[-1][0], batch_size, batch_wait)
+
+        cons_objs.append(cons_obj)
+        cons_obj.start()
+
+    # Every local consumer stops at its own end-of-work marker. Values are thrown away
+    # once every local consumer has stopped (e.g. because its function raised), so that
+    # the node does not block on a full local queue.
+    markers = 0
+
+    while markers < len(slots):
+        for value in coordinator.get_many(node_batch):
+            while any(cons_obj.is_alive() for cons_obj in cons_objs):
+                try:
+                    local.put(value, True, _CANCEL_INTERVAL)
+                    break
+                except Full:
+                    pass
+
+            if isinstance(value, _Sentinel):
+                markers += 1
+
+    for cons_obj in cons_objs:
+        cons_obj.join()
+
+    for (slot, args), cons_obj, cons_pipe in zip(slots, cons_objs, cons_pipes):
+        coordinator.report(slot, cons_pipe[1].recv() if cons_pipe else cons_obj.result)
+
+    return len(slots)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs consumers for a Calculon run in distributed mode.")
+    parser.add_argument("--address", required=True, help="host:port of the server")
+    parser.add_argument("--authkey", required=True, help="key given to the server")
+    parser.add_argument("--consumers", type=int, default=1, help="number of consumers to run (default: 1)")
+    parser.add_argument("--threads", action="store_true", help="run consumers as threads instead of processes")
+    parser.add_argument("--node-batch", type=int, default=100,
+                        help="maximum number of values fetched from the server at once (default: 100)")
+    options = parser.parse_args(argv)
+
+    host, port = options.address.rsplit(":", 1)
+    count = run_node((host, int(port)), options.authkey.encode("utf-8"), options.consumers, options.threads,
+                     options.node_batch)
+
+    sys.stderr.write("ran {0} consumers\n".format(count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import ctypes
+import threading
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+try:
+    from Queue import Empty, Full
+except ImportError:
+    from queue import Empty, Full
+
+
+class _Slot:
+    """Descriptor of a value stored in the ring buffer. This is the only thing
+    that goes through the control queue for values stored in shared memory."""
+    def __init__(self, index, size, dtype=None, shape=None):
+        self.index = index
+        self.size = size
+        self.dtype = dtype
+        self.shape = shape
+
+
+class SharedMemoryQueue:
+    """Queue that keeps values in a fixed-size ring buffer of shared memory slots."""
+    def __init__(self, capacity, slot_size, context=None):
+        """Initializes the ring buffer. Calculon creates the queue when asked to with
+        `shm_capacity`; it can be passed to producers and consumers in place of
+        multiprocessing.Queue.
+
+        Values exposing the buffer interface (strings / bytes, bytearrays, NumPy arrays)
+        are copied into a free slot by `put()`, and only a small slot descriptor is sent
+        to the consumer. `get()` returns a memoryview of the slot (or, for NumPy arrays, an
+        array on top of it) without copying the data. Any other value is pickled and sent
+        through the control queue as usual, which is also how end-of-work markers travel.
+
+        The slot handed out by `get()` belongs to the calling thread / process until its
+        next call to `get()`, so consumers should copy the value (e.g. `value.tobytes()`)
+        if they need to keep it around longer than one call to the consumer function.
+
+        **Keyword arguments**
+
+        * capacity -- number of slots; producers block on `put()` while all of them are in use;
+        * slot_size -- size of a slot in bytes, values larger than that are rejected with ValueError;
+        * context -- multiprocessing context the control queues are created with, for process start methods other than the default one.
+        """
+
+        self.capacity = capacity
+        self.slot_size = slot_size
+
+        # Shared memory is allocated once and inherited by the worker processes.
+        self.buffer = RawArray(ctypes.c_char, capacity * slot_size)
+
+        # Indices of slots that can be written to, and descriptors of slots
+        # (or plain values) that are ready to be read.
+        context = context or multiprocessing
+        self.free = context.Queue()
+        self.ready = context.Queue()
+
+        for index in range(0, capacity):
+            self.free.put(index)
+
+        self._view = None
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Views and thread-local state are per process.
+        state = self.__dict__.copy()
+        del state["_view"]
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._view = None
+        self._local = threading.local()
+
+    def put(self, value, block=True, timeout=None):
+        """Puts a value on the queue, blocking until a slot is free. Raises Full if no slot
+        became free without blocking / within timeout."""
+        try:
+            data = _byte_view(value)
+        except TypeError:
+            self.ready.put(value)
+            return
+
+        size = len(data)
+
+        if size > self.slot_size:
+            raise ValueError("value of {0} bytes does not fit into a slot of {1} bytes".format(size, self.slot_size))
+
+        try:
+            index = self.free.get(block, timeout)
+        except Empty:
+            raise Full
+        offset = index * self.slot_size
+        self._buffer_view()[offset:offset + size] = data
+
+        # NumPy arrays are rebuilt on the other side.
+        dtype, shape = None, None
+        if hasattr(value, "dtype") and hasattr(value, "shape"):
+            dtype, shape = value.dtype.str, value.shape
+
+        self.ready.put(_Slot(index, size, dtype, shape))
+
+    def get(self, block=True, timeout=None):
+        """Gets a value from the queue. Releases the slot returned by the previous call
+        made from the same thread."""
+        self.release()
+
+        item = self.ready.get(block, timeout)
+
+        if not isinstance(item, _Slot):
+            return item
+
+        self._thread_local().held = item.index
+
+        offset = item.index * self.slot_size
+        value = self._buffer_view()[offset:offset + item.size]
+
+        if item.dtype is not None:
+            import numpy
+            value = numpy.frombuffer(value, dtype=item.dtype).reshape(item.shape)
+
+        return value
+
+    def release(self):
+        """Returns the slot held by the calling thread, if any, to the pool of free slots."""
+        local = self._thread_local()
+
+        if local.held is not None:
+            self.free.put(local.held)
+            local.held = None
+
+    def qsize(self):
+        return self.ready.qsize()
+
+    def _buffer_view(self):
+        if self._view is None:
+            self._view = _byte_view(self.buffer)
+        return self._view
+
+    def _thread_local(self):
+        if not hasattr(self._local, "held"):
+            self._local.held = None
+
+        return self._local
+
+
+def _byte_view(obj):
+    """Returns a flat memoryview of bytes over obj, raises TypeError if obj has no buffer interface."""
+    view = memoryview(obj)
+
+    # Python 3 views keep the format and shape of the exporter and can be recast.
+    if hasattr(view, "cast"):
+        if view.format != "B" or view.ndim != 1:
+            view = view.cast("B")
+        return view
+
+    if view.itemsize != 1 or view.ndim != 1:
+        raise TypeError("cannot view {0!r} as bytes".format(type(obj)))
+
+    return view
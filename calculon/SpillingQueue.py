@@ -0,0 +1,211 @@
+import os
+import mmap
+import uuid
+import ctypes
+import struct
+import shutil
+import tempfile
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from Queue import Queue as ThreadQueue, Empty, Full
+except ImportError:
+    from queue import Queue as ThreadQueue, Empty, Full
+
+# Every record of a segment file is the length of the pickle followed by the pickle.
+_LENGTH = struct.Struct("<I")
+
+# Fields of the shared state.
+_WRITE_SEGMENT, _WRITE_OFFSET, _READ_SEGMENT, _READ_OFFSET, _SPILLED, _TOTAL = range(0, 6)
+
+
+class SpillingQueue:
+    """Queue that keeps a bounded number of values in memory and writes the rest to disk."""
+    def __init__(self, max_items, directory=None, segment_size=64 * 1024 * 1024, use_threads=False, context=None):
+        """Initializes the queue. Calculon creates it when `spill_after` is given.
+
+        Values go to the in-memory queue while it has room; once it is full, they are pickled and
+        appended to segment files instead, so `put()` never blocks. Values written to disk are read
+        back (through mmap) in the order they were written, once the in-memory queue is empty, and
+        a segment file is deleted as soon as all of its values have been read. While anything is on
+        disk, new values go to disk as well, behind it.
+
+        **Keyword arguments**
+
+        * max_items -- maximum number of values kept in memory;
+        * directory -- directory of the segment files; by default, a temporary directory that is created on the first spill and removed once the disk backlog is read;
+        * segment_size -- size in bytes after which a new segment file is started;
+        * use_threads -- a flag specifying if the queue is only used by threads (if False, it can be shared with processes);
+        * context -- multiprocessing context the queue is created with, for process start methods other than the default one.
+        """
+
+        context = context or multiprocessing
+
+        self.head = ThreadQueue(max_items) if use_threads else context.Queue(max_items)
+
+        # The directory is only created when needed, but its name has to be
+        # known to every process from the start.
+        self.temporary = directory is None
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "calculon-" + uuid.uuid4().hex)
+        self.segment_size = segment_size
+
+        # Position of the writer and the reader, number of values on disk and
+        # number of values that have been spilled in total.
+        self.state = RawArray(ctypes.c_longlong, 6)
+        self.lock = context.Lock()
+
+        # Values in the queue, in memory or on disk.
+        self.available = context.Semaphore(0)
+
+        self._files = {}
+
+    def __getstate__(self):
+        # Open files and maps are per process.
+        state = self.__dict__.copy()
+        state["_files"] = {}
+        return state
+
+    def put(self, value, block=True, timeout=None):
+        """Puts a value on the queue, in memory if there is room and nothing is on disk, on disk otherwise."""
+        with self.lock:
+            spilled = self.state[_SPILLED] > 0
+
+            if not spilled:
+                try:
+                    self.head.put(value, False)
+                except Full:
+                    spilled = True
+
+            if spilled:
+                self._write(value)
+
+        self.available.release()
+
+    def get(self, block=True, timeout=None):
+        """Gets a value from the queue, from memory first. Raises Empty if there is no value
+        within timeout."""
+        if not self.available.acquire(block, timeout):
+            raise Empty
+
+        while True:
+            try:
+                return self.head.get(False)
+            except Empty:
+                pass
+
+            # Values in memory are older than the ones on disk, even while they
+            # are still on their way through the pipe of a process queue.
+            if not self.head.qsize():
+                with self.lock:
+                    if self.state[_SPILLED]:
+                        return self._read()
+
+            try:
+                return self.head.get(True, 0.01)
+            except Empty:
+                pass
+
+    def qsize(self):
+        return self.head.qsize() + self.state[_SPILLED]
+
+    def spilled(self):
+        """Returns the number of values that have been written to disk so far."""
+        return self.state[_TOTAL]
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "segment-{0:06d}".format(segment))
+
+    def _write(self, value):
+        """Appends a value to the current segment file, starting a new one when it is full."""
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        state = self.state
+
+        if state[_WRITE_OFFSET] and state[_WRITE_OFFSET] + _LENGTH.size + len(data) > self.segment_size:
+            state[_WRITE_SEGMENT] += 1
+            state[_WRITE_OFFSET] = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        with open(self._path(state[_WRITE_SEGMENT]), "ab") as segment:
+            segment.write(_LENGTH.pack(len(data)))
+            segment.write(data)
+
+        state[_WRITE_OFFSET] += _LENGTH.size + len(data)
+        state[_SPILLED] += 1
+        state[_TOTAL] += 1
+
+    def _read(self):
+        """Reads the oldest value on disk, deleting segment files that have been read."""
+        state = self.state
+
+        while True:
+            view = self._map(state[_READ_SEGMENT])
+            offset = state[_READ_OFFSET]
+
+            if offset < len(view):
+                length = _LENGTH.unpack_from(view, offset)[0]
+                start = offset + _LENGTH.size
+                value = pickle.loads(view[start:start + length])
+
+                state[_READ_OFFSET] = start + length
+                state[_SPILLED] -= 1
+
+                if not state[_SPILLED]:
+                    self._finish_segment()
+
+                    # Nothing left on disk, the next spill starts over in a new segment.
+                    state[_WRITE_SEGMENT] += 1
+                    state[_WRITE_OFFSET] = 0
+
+                    if self.temporary:
+                        shutil.rmtree(self.directory, True)
+
+                return value
+
+            self._finish_segment()
+
+    def _finish_segment(self):
+        """Deletes the segment that has been read and moves the reader to the next one."""
+        state = self.state
+        segment = state[_READ_SEGMENT]
+
+        self._unmap(segment)
+        os.remove(self._path(segment))
+
+        state[_READ_SEGMENT] = segment + 1
+        state[_READ_OFFSET] = 0
+
+    def _map(self, segment):
+        """Returns a map of a segment file, mapping it again once the values it covers have been
+        read, as the file may have grown since."""
+        # Segments read by other processes meanwhile have been deleted, close them
+        # so that their disk space is freed.
+        for old in [old for old in self._files if old != segment]:
+            self._unmap(old)
+
+        entry = self._files.get(segment)
+
+        if entry is not None and len(entry[1]) > self.state[_READ_OFFSET]:
+            return entry[1]
+
+        self._unmap(segment)
+
+        segment_file = open(self._path(segment), "rb")
+        segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files[segment] = (segment_file, segment_map)
+
+        return segment_map
+
+    def _unmap(self, segment):
+        entry = self._files.pop(segment, None)
+
+        if entry is not None:
+            entry[1].close()
+            entry[0].close()
@@ -0,0 +1,58 @@
+import time
+import warnings
+import multiprocessing
+from multiprocessing import Process
+
+
+def check_start_method(start_method, preload=None):
+    """Validates a start method given to Calculon and sets up forkserver preloading. Python 2 has no
+    start methods other than fork, so there the start method falls back to the default with a warning.
+    Returns the start method to use."""
+    if start_method is None:
+        return None
+
+    if not hasattr(multiprocessing, "get_context"):
+        if start_method != "fork":
+            warnings.warn("start method {0!r} requires Python 3.4 or newer, "
+                          "using the default one".format(start_method), RuntimeWarning)
+        return None
+
+    context = multiprocessing.get_context(start_method)
+
+    if preload and start_method == "forkserver":
+        context.set_forkserver_preload(list(preload))
+
+    return start_method
+
+
+def get_context(start_method):
+    """Returns the multiprocessing context of a start method, or the multiprocessing
+    module itself (the default context) if start_method is not set."""
+    if start_method is None:
+        return multiprocessing
+
+    return multiprocessing.get_context(start_method)
+
+
+class _StartMethodProcess(Process):
+    """Process started through the multiprocessing context of a given start method. Also
+    records when it was started, so that the worker can report how long it took to come up."""
+    def __init__(self, start_method=None):
+        Process.__init__(self)
+        self.start_method = start_method
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+        Process.start(self)
+
+    def _Popen(self, process_obj):
+        if self.start_method is not None:
+            return multiprocessing.get_context(self.start_method).Process._Popen(process_obj)
+
+        # Python 2 leaves _Popen unset and forks.
+        if Process._Popen is None:
+            from multiprocessing.forking import Popen
+            return Popen(process_obj)
+
+        return Process._Popen(process_obj)
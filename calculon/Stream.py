@@ -0,0 +1,70 @@
+from threading import Thread
+
+try:
+    from Queue import Queue as ThreadQueue
+except ImportError:
+    from queue import Queue as ThreadQueue
+
+from .Consumer import _Sentinel
+
+
+class ResultStream:
+    """Iterator over consumer outputs of a Calculon run, returned by Calculon.stream()."""
+    def __init__(self, calculon, buffer_size):
+        """Starts the run in a background thread.
+
+        **Keyword arguments**
+
+        * calculon -- the Calculon instance to run;
+        * buffer_size -- number of outputs held until they are taken by the iterator; consumers block while the buffer is full.
+        """
+
+        if calculon.cons_use_threads:
+            self.output = ThreadQueue(buffer_size)
+        else:
+            self.output = calculon.context.Queue(buffer_size)
+
+        # Result of the run, set once the stream is exhausted.
+        self.result = None
+
+        self.error = None
+        self.finished = False
+
+        self.thread = Thread(target=self._run, args=(calculon,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+
+        value = self.output.get()
+
+        if isinstance(value, _Sentinel):
+            self.finished = True
+            self.thread.join()
+
+            if self.error is not None:
+                raise self.error
+
+            raise StopIteration
+
+        return value
+
+    next = __next__
+
+    def _run(self, calculon):
+        calculon.output = self.output
+
+        try:
+            self.result = calculon.start()
+        except Exception as e:
+            self.error = e
+        finally:
+            calculon.output = None
+
+            # Consumers have been joined, so this goes behind all of their outputs.
+            self.output.put(_Sentinel())
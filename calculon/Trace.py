@@ -0,0 +1,84 @@
+import os
+import json
+import time
+from collections import deque
+
+# Category of each kind of span, used to colour the timeline.
+_CATEGORIES = {"prod_func": "func",
+               "cons_func": "func",
+               "queue.get": "queue",
+               "queue.put": "queue"}
+
+
+class SpanBuffer:
+    """Ring buffer of the timed spans of one worker; the oldest spans are dropped once it is full."""
+    def __init__(self, size):
+        """Initializes the buffer.
+
+        **Keyword arguments**
+
+        * size -- the maximum number of spans kept.
+        """
+
+        self.spans = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, name, started, finished=None):
+        """Records a span that started at `started` (seconds since the epoch) and finished now, or at `finished`."""
+        self.spans.append((name, started, time.time() if finished is None else finished))
+        self.count += 1
+
+    def export(self):
+        """Returns the spans in a picklable dictionary, to be sent along with the result of the worker."""
+        return {"pid": os.getpid(),
+                "spans": list(self.spans),
+                "dropped": self.count - len(self.spans)}
+
+
+def write_trace(path, origin, workers):
+    """Writes the spans of a run to a file in the Chrome Trace Event format, which can be opened in
+    Perfetto (ui.perfetto.dev) or chrome://tracing. Every worker gets a row of its own, grouped by process.
+
+    **Keyword arguments**
+
+    * path -- the file to write;
+    * origin -- time (seconds since the epoch) the timeline starts at;
+    * workers -- list of (label, trace) tuples, where trace is the dictionary returned by SpanBuffer.export().
+
+    **Returns**
+        Returns the number of spans written.
+    """
+
+    events = []
+    processes = {}
+
+    for tid, (label, trace) in enumerate(workers):
+        pid = trace["pid"]
+
+        # A process of its own is named after its worker, the calling process after Calculon.
+        if processes.get(pid) is None or label == "calculon":
+            processes[pid] = label
+
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": label}})
+        events.append({"name": "thread_sort_index", "ph": "M", "pid": pid, "tid": tid, "args": {"sort_index": tid}})
+
+        if trace["dropped"]:
+            events.append({"name": "dropped", "ph": "i", "s": "t", "pid": pid, "tid": tid, "ts": 0,
+                           "args": {"spans": trace["dropped"]}})
+
+        for name, started, finished in trace["spans"]:
+            events.append({"name": name,
+                           "cat": _CATEGORIES.get(name, "worker"),
+                           "ph": "X",
+                           "pid": pid,
+                           "tid": tid,
+                           "ts": (started - origin) * 1000000,
+                           "dur": (finished - started) * 1000000})
+
+    for pid, label in processes.items():
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": label}})
+
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+    return sum(len(trace["spans"]) for label, trace in workers)
@@ -0,0 +1,184 @@
+import ctypes
+import threading
+import multiprocessing
+from collections import deque
+
+try:
+    from Queue import Queue as ThreadQueue, Empty
+except ImportError:
+    from queue import Queue as ThreadQueue, Empty
+
+from .Consumer import _Sentinel
+
+# How long an idle consumer blocks on its own queue before it looks at the other queues again.
+_IDLE_WAIT = 0.05
+
+
+class WorkStealingQueue:
+    """Set of queues, one per consumer, that producers fill in turns. A consumer takes values from
+    its own queue and, once that is empty, steals half of the backlog of the busiest other queue."""
+    def __init__(self, consumers, chunk=1, max_items=0, use_threads=False, context=None):
+        """Initializes the queues. Calculon creates it when `work_stealing` is set, producers put values
+        on it and consumer number i gets values from `local(i)`.
+
+        Nothing is shared on the way from a producer to a consumer but the queue itself, so a consumer
+        with a backlog of its own pays no more for a value than with a plain queue. A consumer whose
+        queue is empty steals from the other queues, leaving the last value to the owner of a queue
+        unless the owner has stopped (see `abandon()`), and blocks on its own queue if there is nothing to steal, looking at the other queues
+        again if nothing came in for `_IDLE_WAIT` seconds. Every consumer stops once it has received its own
+        end-of-work marker (see `_LocalQueue.put()`) and there is nothing left to steal.
+
+        **Keyword arguments**
+
+        * consumers -- number of queues, i.e. of consumers;
+        * chunk -- number of consecutive values a producer puts on the same queue before moving on to the next one;
+        * max_items -- maximum number of values in each of the queues, 0 for no limit;
+        * use_threads -- a flag specifying if the queues are only used by threads (if False, they can be shared with processes);
+        * context -- multiprocessing context the queues are created with, for process start methods other than the default one.
+        """
+
+        self.chunk = chunk
+
+        # One thief at a time per queue, so that the owner always finds the value it counted.
+        # A queue is abandoned once its owner has stopped, see abandon().
+        if use_threads:
+            self.queues = [ThreadQueue(max_items) for i in range(0, consumers)]
+            self.steal_locks = [threading.Lock() for i in range(0, consumers)]
+            self.abandoned = [False] * consumers
+            self.put_count = 0
+        else:
+            context = context or multiprocessing
+            self.queues = [context.Queue(max_items) for i in range(0, consumers)]
+            self.steal_locks = [context.Lock() for i in range(0, consumers)]
+            self.abandoned = context.RawArray(ctypes.c_bool, consumers)
+
+            # Every producer process puts on its own copy of the queue, see put().
+            self.put_count = None
+            self.turns = context.Value(ctypes.c_long, 0)
+
+    def put(self, value, block=True, timeout=None):
+        """Puts a value on the queue whose turn it is. Producer threads take turns together, every
+        producer process on its own, starting one chunk further than the process that started before it
+        (in this run or in a previous one), so that they do not all fill the first queue first."""
+        if self.put_count is None:
+            with self.turns.get_lock():
+                self.put_count = self.turns.value * self.chunk
+                self.turns.value += 1
+
+        queue = self.queues[self.put_count // self.chunk % len(self.queues)]
+        queue.put(value, block, timeout)
+
+        self.put_count += 1
+
+    def local(self, index):
+        """Returns the handle consumer number index gets its values from."""
+        return _LocalQueue(self, index)
+
+    def abandon(self, index):
+        """Tells the other consumers that consumer number index has stopped (e.g. its function raised), so
+        that they steal every value of its queue, the last one included."""
+        self.abandoned[index] = True
+
+    def close(self):
+        """Tells every consumer to stop once there is nothing left for it."""
+        for queue in self.queues:
+            queue.put(_Sentinel())
+
+    def qsize(self):
+        """Returns the number of values in all of the queues together."""
+        return sum(queue.qsize() for queue in self.queues)
+
+
+class _LocalQueue:
+    """Consumer-side handle of a WorkStealingQueue. Values stolen from other queues go to a
+    deque private to the consumer, so that they cannot be stolen back."""
+    def __init__(self, owner, index):
+        self.owner = owner
+        self.index = index
+        self.stolen = deque()
+        self.ended = False
+
+    def get(self):
+        """Returns the next value to process, blocking until there is one. Returns an end-of-work
+        marker once the marker of this consumer has been received and there is nothing to steal."""
+        if self.stolen:
+            return self.stolen.popleft()
+
+        queue = self.owner.queues[self.index]
+
+        while True:
+            # Thieves leave the last value of a queue to its owner, so a counted value is there to be
+            # taken, if still on its way through the pipe of a process queue. Should a thief get it
+            # after all, the next value put on the queue (at the latest, the end-of-work marker) will do.
+            if queue.qsize():
+                value = queue.get()
+            else:
+                found, value = self._steal()
+
+                if found:
+                    return value
+
+                if self.ended:
+                    return _Sentinel()
+
+                try:
+                    value = queue.get(True, _IDLE_WAIT)
+                except Empty:
+                    continue
+
+            if not isinstance(value, _Sentinel):
+                return value
+
+            # The end-of-work marker of this consumer, which stops once there is nothing left to steal.
+            self.ended = True
+
+    def put(self, value, block=True, timeout=None):
+        """Puts a value (or, from _Consumer.shutdown(), an end-of-work marker) on the own queue."""
+        self.owner.queues[self.index].put(value, block, timeout)
+
+    def qsize(self):
+        return self.owner.qsize() + len(self.stolen)
+
+    def _steal(self):
+        """Steals half of the backlog of the busiest other queue that has at least two values, or the
+        whole backlog of an abandoned queue. Returns a (found, value) tuple."""
+        queues = self.owner.queues
+        victims = sorted((queue.qsize(), id) for id, queue in enumerate(queues) if id != self.index)
+
+        for size, id in reversed(victims):
+            abandoned = self.owner.abandoned[id]
+
+            if size < (1 if abandoned else 2):
+                continue
+
+            lock = self.owner.steal_locks[id]
+
+            if not lock.acquire(False):
+                continue
+
+            values = []
+
+            try:
+                size = queues[id].qsize()
+
+                for i in range(0, size if abandoned else size // 2):
+                    try:
+                        value = queues[id].get(False)
+                    except Empty:
+                        break
+
+                    # The marker of the owner, which came before values still
+                    # on their way; it has to go back to the owner.
+                    if isinstance(value, _Sentinel):
+                        queues[id].put(value)
+                        break
+
+                    values.append(value)
+            finally:
+                lock.release()
+
+            if values:
+                self.stolen.extend(values[1:])
+                return True, values[0]
+
+        return False, None
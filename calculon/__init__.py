@@ -1,3 +1,13 @@
-from Calculon import Calculon
-from Producer import ProducerThread, ProducerProcess, _Producer
-from Consumer import ConsumerThread, ConsumerProcess, _Consumer
+from .Calculon import Calculon
+from .Producer import ProducerThread, ProducerProcess, _Producer, Cancelled
+from .Consumer import ConsumerThread, ConsumerProcess, _Consumer
+from .SharedQueue import SharedMemoryQueue
+from .BoundedQueue import BoundedQueue
+from .PartitionedQueue import PartitionedQueue
+from .WorkStealingQueue import WorkStealingQueue
+from .SpillingQueue import SpillingQueue
+from .Cache import LRUCache
+from .Remote import run_node
+from .Metrics import Histogram
+from .Pool import WorkerPool
+from .Pipeline import Pipeline
@@ -0,0 +1,208 @@
+"""Benchmark suite for Calculon.
+
+Sweeps the four thread / process combinations of producers and consumers over
+producer / consumer counts, item counts, payload sizes, consumer workloads and
+queue types, and prints the measurements as JSON. It is not installed with the package, run
+it from the root of a source checkout:
+
+    $ PYTHONPATH=. python calculon/benchmark/benchmark.py --output results.json
+
+and use --help to narrow the sweep down.
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import multiprocessing
+
+from calculon import Calculon
+
+WORKLOADS = ["none", "cpu", "sleep", "skewed"]
+
+QUEUES = ["shared", "work-stealing"]
+
+MODES = {
+    "thread": (True, True),
+    "process": (False, False),
+    "thread-process": (True, False),
+    "process-thread": (False, True),
+}
+
+
+def producer(args):
+    """Puts `items` copies of the payload on the queue, or the integers up to `items` without a payload."""
+    size = args["payload_size"]
+    payload = b"x" * size if size else None
+
+    for i in range(0, args["items"]):
+        args["_queue"].put(i if payload is None else payload)
+
+    return args["items"]
+
+
+def consumer(args):
+    """Does the configured amount of work for every value and counts the values. The skewed workload is
+    the cpu one, 20 times over for the integer values of every tenth run of 100, so that the values that cost
+    the most come in bursts."""
+    if args["_last_call"]:
+        return args["_result"] or 0
+
+    workload = args["workload"]
+
+    if workload in ("cpu", "skewed"):
+        work = args["cpu_work"]
+
+        if workload == "skewed" and isinstance(args["_value"], int) and args["_value"] // 100 % 10 == 0:
+            work *= 20
+
+        total = 0
+        for i in range(0, work):
+            total += i
+    elif workload == "sleep":
+        time.sleep(args["sleep_work"])
+
+    return (args["_result"] or 0) + 1
+
+
+def split(total, parts):
+    """Splits total into parts that differ by at most one."""
+    return [total // parts + (1 if i < total % parts else 0) for i in range(0, parts)]
+
+
+def run_case(mode, producers, consumers, items, payload_size, workload, queue, options):
+    """Runs Calculon once and returns the measurements."""
+    prod_use_threads, cons_use_threads = MODES[mode]
+
+    prod_kwargs = [{"items": count, "payload_size": payload_size} for count in split(items, producers)]
+    cons_kwargs = [{"workload": workload, "cpu_work": options.cpu_work, "sleep_work": options.sleep_work}
+                   for i in range(0, consumers)]
+
+    calculon = Calculon(producer, prod_kwargs, prod_use_threads, consumer, cons_kwargs, cons_use_threads,
+                        metrics=options.metrics, work_stealing=queue == "work-stealing",
+                        distribution_chunk=options.distribution_chunk)
+
+    started = time.time()
+    result = calculon.start()
+    elapsed = time.time() - started
+
+    consumed = sum(res.get("result", 0) for res in result["consumers"])
+    errors = [repr(res["exception"]) for res in result["producers"] + result["consumers"] if "exception" in res]
+
+    case = {
+        "mode": mode,
+        "producers": producers,
+        "consumers": consumers,
+        "items": items,
+        "payload_size": payload_size,
+        "workload": workload,
+        "queue": queue,
+        "elapsed": elapsed,
+        "throughput": consumed / elapsed if elapsed else None,
+        "bytes_per_second": consumed * payload_size / elapsed if elapsed else None,
+        "consumed": consumed,
+        "errors": errors,
+    }
+
+    if options.metrics:
+        latency = result["metrics"]["latency"]
+        depths = [depth for seconds, depth in result["metrics"]["queue_depth"]]
+
+        case["latency"] = {"mean": latency.mean(),
+                           "p50": latency.percentile(50),
+                           "p99": latency.percentile(99),
+                           "max": latency.max}
+        case["max_queue_depth"] = max(depths) if depths else 0
+        case["consumer_idle"] = sum(m["idle"] for m in result["metrics"]["consumers"])
+        case["consumer_busy"] = sum(m["busy"] for m in result["metrics"]["consumers"])
+
+    return case
+
+
+def int_list(value):
+    return [int(part) for part in value.split(",")]
+
+
+def str_list(value):
+    return value.split(",")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calculon benchmark suite.")
+    parser.add_argument("--modes", type=str_list, default=sorted(MODES),
+                        help="comma-separated producer-consumer modes (default: all of %(default)s)")
+    parser.add_argument("--producers", type=int_list, default=[1, 4],
+                        help="comma-separated producer counts (default: 1,4)")
+    parser.add_argument("--consumers", type=int_list, default=[1, 4, 30],
+                        help="comma-separated consumer counts (default: 1,4,30)")
+    parser.add_argument("--items", type=int_list, default=[2000],
+                        help="comma-separated total number of values per run (default: 2000)")
+    parser.add_argument("--payload-sizes", type=int_list, default=[0, 1024, 65536, 4 * 1024 * 1024],
+                        help="comma-separated payload sizes in bytes, 0 for ints (default: 0,1024,65536,4194304)")
+    parser.add_argument("--max-bytes", type=int, default=256 * 1024 * 1024,
+                        help="cap on payload bytes moved in one run, lowers the item count for large payloads")
+    parser.add_argument("--workloads", type=str_list, default=WORKLOADS[:3],
+                        help="comma-separated consumer workloads out of none, cpu, sleep, skewed (default: none,cpu,sleep)")
+    parser.add_argument("--cpu-work", type=int, default=1000,
+                        help="loop iterations per value for the cpu workload (default: 1000)")
+    parser.add_argument("--sleep-work", type=float, default=0.001,
+                        help="seconds per value for the sleep workload (default: 0.001)")
+    parser.add_argument("--queues", type=str_list, default=QUEUES[:1],
+                        help="comma-separated queue types out of shared, work-stealing (default: shared)")
+    parser.add_argument("--distribution-chunk", type=int, default=1,
+                        help="values a producer puts on the same queue in a row when work stealing (default: 1)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="number of runs of every case (default: 1)")
+    parser.add_argument("--metrics", action="store_true",
+                        help="collect latency and queue depth metrics (adds some overhead)")
+    parser.add_argument("--output", help="file to write the JSON to (default: standard output)")
+    options = parser.parse_args(argv)
+
+    unknown = set(options.modes) - set(MODES)
+    if unknown:
+        parser.error("unknown modes: {0}".format(", ".join(sorted(unknown))))
+
+    unknown = set(options.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error("unknown workloads: {0}".format(", ".join(sorted(unknown))))
+
+    unknown = set(options.queues) - set(QUEUES)
+    if unknown:
+        parser.error("unknown queues: {0}".format(", ".join(sorted(unknown))))
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpu_count": multiprocessing.cpu_count(),
+        },
+        "options": vars(options),
+        "results": [],
+    }
+
+    cases = itertools.product(options.modes, options.producers, options.consumers, options.items,
+                              options.payload_sizes, options.workloads, options.queues)
+
+    for mode, producers, consumers, items, payload_size, workload, queue in cases:
+        if payload_size:
+            items = max(min(items, options.max_bytes // payload_size), producers)
+
+        for i in range(0, options.repeat):
+            case = run_case(mode, producers, consumers, items, payload_size, workload, queue, options)
+            report["results"].append(case)
+
+            sys.stderr.write("{mode} p={producers} c={consumers} n={items} size={payload_size} "
+                             "{workload} {queue}: {throughput:.0f} values/s\n".format(**case))
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
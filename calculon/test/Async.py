@@ -0,0 +1,107 @@
+import time
+import asyncio
+import random
+import unittest
+
+from calculon import Calculon
+
+NUM_RESULTS = 5
+
+
+async def prod_function(kwargs):
+    """Producer coroutine that generates random integers, pretending
+    to wait for I/O before each one. It returns a list of generated
+    integers."""
+    kwargs['_name']
+
+    queue = kwargs['_queue']
+
+    values = []
+    for i in range(0, NUM_RESULTS):
+        await asyncio.sleep(0.01)
+        value = random.randint(1, 10)
+        values.append(value)
+        await queue.put(value)
+
+    return values
+
+
+async def cons_function(kwargs):
+    """Consumer coroutine that stores integers from the queue in
+    a list passed throughout the calls."""
+    kwargs['_name']
+    result = kwargs['_result'] or []
+
+    if kwargs['_last_call']:
+        return result
+
+    await asyncio.sleep(0.01)
+
+    return result + [kwargs['_value']]
+
+
+def sync_cons_function(kwargs):
+    """Plain consumer function, raises on the first value."""
+    if not kwargs['_last_call']:
+        raise ValueError(kwargs['_value'])
+
+
+def failing_cons_function(kwargs):
+    """Plain consumer function, raises on the first value if kwargs['fail']
+    is set, otherwise returns the values it received on the last call."""
+    if kwargs.get('fail'):
+        raise ValueError([kwargs['_value']])
+
+    result = kwargs['_result'] or []
+
+    if kwargs['_last_call']:
+        return result
+
+    return result + [kwargs['_value']]
+
+
+class TestAsync(unittest.TestCase):
+
+    def test_calculon_async(self):
+        """Thousands of producers and consumers run on one event loop."""
+        NUM_PROD = 1000
+        NUM_CONS = 1000
+
+        c = Calculon(prod_function, [{} for i in range(NUM_PROD)], True,
+                     cons_function, [{} for i in range(NUM_CONS)], True)
+
+        started = time.time()
+        result = asyncio.run(c.start_async(max_queue_size=100))
+
+        # Waits overlap instead of adding up.
+        self.assertTrue(time.time() - started < 5)
+
+        self.assertTrue(len(result["producers"]) == NUM_PROD)
+        self.assertTrue(len(result["consumers"]) == NUM_CONS)
+
+        prod_sum = sum(sum(p["result"]) for p in result["producers"])
+        cons_sum = sum(sum(c["result"]) for c in result["consumers"])
+
+        self.assertTrue(prod_sum == cons_sum)
+
+    def test_exceptions(self):
+        """Exceptions end up in the result, like with threads / processes."""
+        c = Calculon(prod_function, [{}], True, sync_cons_function, [{}], True)
+        result = asyncio.run(c.start_async())
+
+        self.assertTrue(isinstance(result["consumers"][0]["exception"], ValueError))
+
+    def test_failed_consumer_values(self):
+        """Values left behind by a consumer that fails go to the other consumers."""
+        c = Calculon(prod_function, [{} for i in range(0, 10)], True, failing_cons_function, [{"fail": True}, {}], True)
+        result = asyncio.run(c.start_async(max_queue_size=1))
+
+        prod_values = sum([p["result"] for p in result["producers"]], [])
+
+        # All but the value the consumer failed on.
+        failed = result["consumers"][0]["exception"].args[0]
+        self.assertTrue(sorted(result["consumers"][1]["result"] + failed) == sorted(prod_values))
+
+
+if __name__ == '__main__':
+    unittest.main()
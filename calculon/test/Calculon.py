@@ -1,10 +1,37 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
 import random
 import unittest
+import pstats
+import warnings
+import threading
+import multiprocessing
+
+try:
+    from Queue import Full, Empty
+except ImportError:
+    from queue import Full, Empty
 from multiprocessing import Queue, Pipe
 
 from calculon import Calculon
 from calculon import ProducerProcess, ProducerThread
 from calculon import ConsumerProcess, ConsumerThread
+from calculon import SharedMemoryQueue
+from calculon import WorkerPool
+from calculon import BoundedQueue
+from calculon import Histogram
+from calculon import Pipeline
+from calculon import PartitionedQueue
+from calculon.PartitionedQueue import _hash
+from calculon import WorkStealingQueue
+from calculon import SpillingQueue
+from calculon import LRUCache
+from calculon import run_node
+from calculon.Consumer import _Sentinel, _Journal
 
 NUM_RESULTS = 5
 
@@ -60,6 +87,256 @@ def cons_function(kwargs):
     return int_list
 
 
+def batch_cons_function(kwargs):
+    """Consumer function for batch mode, gets lists of integers
+    and stores them in a list passed throughout the calls."""
+    values = kwargs['_values']
+    result = kwargs['_result'] or []
+
+    if kwargs['_last_call']:
+        return result
+
+    # Never more than a batch at a time.
+    assert len(values) <= kwargs['batch_size']
+
+    return result + values
+
+
+PAYLOAD = {"data": list(range(1000))}
+
+
+def payload_prod_function(kwargs):
+    """Producer function that puts the same object on the queue."""
+    kwargs['_queue'].put(PAYLOAD)
+
+
+def payload_cons_function(kwargs):
+    """Consumer function that counts values that are the very same
+    object that the producer put on the queue."""
+    result = kwargs['_result'] or 0
+
+    if kwargs['_last_call']:
+        return result
+
+    return result + (kwargs['_value'] is PAYLOAD)
+
+
+def bytes_prod_function(kwargs):
+    """Producer function that puts byte strings on the queue."""
+    for i in range(0, kwargs['count']):
+        kwargs['_queue'].put(str(i).encode() * 100)
+
+    return kwargs['count']
+
+
+def bytes_cons_function(kwargs):
+    """Consumer function that copies byte strings out of the queue."""
+    result = kwargs['_result'] or []
+
+    if kwargs['_last_call']:
+        return result
+
+    return result + [kwargs['_value'].tobytes()]
+
+
+def slow_cons_function(kwargs):
+    """Consumer function that takes its time with every value."""
+    time.sleep(0.01)
+    return cons_function(kwargs)
+
+
+def gen_prod_function(kwargs):
+    """Generator producer function that yields the integers
+    up to kwargs['count']."""
+    for i in range(0, kwargs['count']):
+        yield i
+
+
+def dying_prod_function(kwargs):
+    """Producer function whose process dies before putting anything."""
+    os._exit(1)
+
+
+def double_cons_function(kwargs):
+    """Consumer function for streaming, returns every value doubled
+    and the last output again on the last call."""
+    if kwargs['_last_call']:
+        return kwargs['_result']
+
+    return kwargs['_value'] * 2
+
+
+def odd_cons_function(kwargs):
+    """Consumer function for pipelines, passes odd values on
+    and drops even ones."""
+    if kwargs['_last_call']:
+        return None
+
+    value = kwargs['_value']
+    return value if value % 2 else None
+
+
+def count_cons_function(kwargs):
+    """Consumer function that returns the values it received
+    on the last call."""
+    result = kwargs['_result'] or []
+
+    if kwargs['_last_call']:
+        return result
+
+    return result + [kwargs['_value']]
+
+
+def square(value):
+    """Function for Calculon.map, sleeps longer on small values so that
+    chunks finish out of order."""
+    if value < 5:
+        time.sleep(0.01)
+
+    if value < 0:
+        raise ValueError(value)
+
+    return value * value
+
+
+def skewed_cons_function(kwargs):
+    """Consumer function for work stealing, values that are multiples
+    of 10 take much longer than the others."""
+    if not kwargs['_last_call'] and kwargs['_value'] % 10 == 0:
+        time.sleep(0.02)
+
+    return count_cons_function(kwargs)
+
+
+def expensive_cons_function(kwargs):
+    """Deterministic consumer function for caching, returns the value
+    tagged with the calling consumer, and in the end the number of
+    times `_result` held the output of another consumer."""
+    result = kwargs['_result']
+
+    if result is not None and result[1] != kwargs['_name']:
+        kwargs['foreign'] = kwargs.get('foreign', 0) + 1
+
+    if kwargs['_last_call']:
+        return kwargs.get('foreign', 0)
+
+    time.sleep(0.001)
+    return kwargs['_value'] % 10, kwargs['_name']
+
+
+def user_prod_function(kwargs):
+    """Generator producer function that yields values keyed by user."""
+    for i in range(0, kwargs['count']):
+        yield ("user", str(i % 5)), i
+
+
+def user_key(value):
+    """Partition key function for user_prod_function values."""
+    return value[0]
+
+
+def parity(value):
+    """Partition key function."""
+    return value % 2
+
+
+def endless_prod_function(kwargs):
+    """Producer function that puts values on the queue until the run is cancelled."""
+    queue = kwargs['_queue']
+    i = 0
+
+    while True:
+        queue.put(i)
+        i += 1
+
+
+def search_cons_function(kwargs):
+    """Consumer function that cancels the run once it finds the target value."""
+    if not kwargs['_last_call'] and kwargs['_value'] == kwargs['target']:
+        kwargs['_cancelled'].set()
+        return kwargs['_value']
+
+    return kwargs['_result']
+
+
+def flaky_cons_function(kwargs):
+    """Consumer function that fails on 0 and on the first attempt
+    at every other value, returns the list of values it processed."""
+    if kwargs['_last_call']:
+        return kwargs['_result']
+
+    value = kwargs['_value']
+    seen = kwargs.setdefault('seen', set())
+
+    if value == 0:
+        raise ValueError("bad value")
+
+    if value not in seen:
+        seen.add(value)
+        raise ValueError("try again")
+
+    return (kwargs['_result'] or []) + [value]
+
+
+def crashing_cons_function(kwargs):
+    """Consumer function whose process dies on 13 and the first
+    time it gets 5, returns the list of values it processed."""
+    if not kwargs['_last_call']:
+        value = kwargs['_value']
+        flag = os.path.join(kwargs['directory'], "crashed")
+
+        if value == 13:
+            os._exit(1)
+
+        if value == 5 and not os.path.exists(flag):
+            open(flag, "w").close()
+            os._exit(1)
+
+        # The process that got 5 again may die on 13 later, taking its result along.
+        if value == 5:
+            open(os.path.join(kwargs['directory'], "retried"), "w").close()
+
+    return count_cons_function(kwargs)
+
+
+def dying_cons_function(kwargs):
+    """Consumer function whose process dies on every value."""
+    if not kwargs['_last_call']:
+        os._exit(1)
+
+
+def unpicklable_cons_function(kwargs):
+    """Consumer function whose result cannot be pickled."""
+    if kwargs['_last_call']:
+        return threading.Lock()
+
+
+def put_values(queue, count):
+    """Puts the integers up to count on a queue."""
+    for i in range(0, count):
+        queue.put(i)
+
+
+def failing_cons_function(kwargs):
+    """Consumer function that fails on the first value it gets."""
+    raise ValueError("bad value")
+
+
+def failing_or_count_cons_function(kwargs):
+    """Consumer function that fails on the first value (or batch of values)
+    it gets if kwargs['fail'] is set, passing it on with the exception, and
+    otherwise returns the values it received on the last call."""
+    if kwargs.get('fail'):
+        raise ValueError(kwargs.get('_values') or [kwargs['_value']])
+
+    result = kwargs['_result'] or []
+
+    if kwargs['_last_call']:
+        return result
+
+    return result + (kwargs.get('_values') or [kwargs['_value']])
+
+
 class TestCalculon(unittest.TestCase):
 
     def setUp(self):
@@ -138,6 +415,29 @@ class TestCalculon(unittest.TestCase):
         for value in result:
             self.assertTrue(str(value), value in range(1, 11))
 
+    def test_consumer_wakeup(self):
+        """Check that consumers pick up late values and stop right after shutdown."""
+        ct = ConsumerThread(cons_function, {'add': 5}, self.queue)
+        cp = ConsumerProcess(cons_function, {'add': 5}, self.queue, self.pipe[0])
+        ct.start()
+        cp.start()
+
+        started = time.time()
+        for i in range(0, NUM_RESULTS):
+            self.queue.put(i)
+
+        ct.shutdown()
+        cp.shutdown()
+        ct.join()
+        cp.join()
+
+        # No polling delay on the way out.
+        self.assertTrue(time.time() - started < 1)
+
+        # Both consumers together got every value.
+        result = ct.result["result"] + self.pipe[1].recv()["result"]
+        self.assertTrue(len(result) == NUM_RESULTS + 2)
+
     def test_calculon_thread(self):
         """The four Calculon tests check that we can run calculon as thread/process/combination.
         The idea is to generate random numbers in producer, retrieve them through consumer,
@@ -249,6 +549,835 @@ class TestCalculon(unittest.TestCase):
 
         self.assertTrue(prod_sum == cons_sum)
 
+    def test_calculon_batches(self):
+        """Values go through the queue in batches, both for threads and processes."""
+        for use_threads in (True, False):
+            p_args = [{"add": 0} for i in range(10)]
+            c_args = [{"batch_size": 3} for i in range(4)]
+
+            c = Calculon(prod_function, p_args, use_threads, batch_cons_function, c_args, use_threads,
+                         batch_size=3, batch_wait=0.1)
+            result = c.start()
+
+            prod_sum = sum(sum(p["result"]) for p in result["producers"])
+            cons_sum = sum(sum(c["result"]) for c in result["consumers"])
+
+            self.assertTrue(prod_sum == cons_sum)
+            self.assertTrue(result["batch_size"] == 3)
+
+    def test_calculon_thread_no_copy(self):
+        """With threads only, values are passed by reference, without pickling."""
+        c = Calculon(payload_prod_function, [{} for i in range(5)], True,
+                     payload_cons_function, [{} for i in range(2)], True)
+        result = c.start()
+
+        self.assertTrue(sum(c["result"] for c in result["consumers"]) == 5)
+
+    def test_calculon_shared_memory(self):
+        """Byte strings go through the shared memory slots, other values through the pipe."""
+        calc = Calculon(bytes_prod_function, [{"count": 20} for i in range(3)], False,
+                        bytes_cons_function, [{} for i in range(2)], False,
+                        shm_capacity=4, shm_slot_size=256)
+        result = calc.start()
+
+        values = []
+        for c in result["consumers"]:
+            values += c["result"]
+
+        self.assertTrue(len(values) == 60)
+        self.assertTrue(sorted(set(values)) == sorted(str(i).encode() * 100 for i in range(20)))
+
+        # Every slot was handed back.
+        self.assertTrue(calc.queue.free.qsize() == 4)
+
+    def test_shared_memory_failed_consumers(self):
+        """Consumers that fail hand their slots back, so that producers do not run out of them."""
+        for use_threads in (True, False):
+            calc = Calculon(bytes_prod_function, [{"count": 20}], False,
+                            failing_cons_function, [{} for i in range(2)], use_threads,
+                            shm_capacity=2, shm_slot_size=256)
+            result = calc.start()
+
+            self.assertTrue(all(isinstance(c["exception"], ValueError) for c in result["consumers"]))
+            self.assertTrue(calc.queue.free.qsize() == 2)
+
+    def test_shared_memory_slot_size(self):
+        """Values that do not fit into a slot are rejected."""
+        queue = SharedMemoryQueue(1, 10)
+        self.assertRaises(ValueError, queue.put, b"x" * 11)
+
+        queue.put(b"x" * 10)
+        self.assertTrue(queue.get().tobytes() == b"x" * 10)
+
+    def test_worker_pool(self):
+        """Workers of a pool run several Calculon runs, each one gets its own results."""
+        for use_threads in (True, False):
+            pool = WorkerPool(4, use_threads)
+
+            for num_prod, num_cons in ((3, 2), (1, 5), (6, 3)):
+                p_args = [{"add": 0} for i in range(num_prod)]
+                c_args = [{"add": 0} for i in range(num_cons)]
+
+                c = Calculon(prod_function, p_args, True, cons_function, c_args, True, pool=pool)
+                result = c.start()
+
+                self.assertTrue(len(result["producers"]) == num_prod)
+                self.assertTrue(len(result["consumers"]) == num_cons)
+
+                prod_sum = sum(sum(p["result"]) for p in result["producers"])
+                cons_sum = sum(sum(c["result"]) for c in result["consumers"])
+
+                self.assertTrue(prod_sum == cons_sum)
+
+            # Same workers all along.
+            self.assertTrue(all(worker.is_alive() for worker in pool.workers))
+
+            pool.close()
+
+    def test_worker_pool_failed_run(self):
+        """A run whose consumers all fail leaves nothing behind for the next run."""
+        for use_threads in (True, False):
+            pool = WorkerPool(3, use_threads)
+
+            result = pool.submit_run(gen_prod_function, [{"count": 100} for i in range(2)],
+                                     failing_cons_function, [{} for i in range(2)])
+            self.assertTrue(all(isinstance(c["exception"], ValueError) for c in result["consumers"]))
+
+            result = pool.submit_run(prod_function, [{"add": 0} for i in range(2)],
+                                     cons_function, [{"add": 0} for i in range(2)])
+
+            prod_sum = sum(sum(p["result"]) for p in result["producers"])
+            cons_sum = sum(sum(c["result"]) for c in result["consumers"])
+
+            self.assertTrue(prod_sum == cons_sum)
+            self.assertTrue(pool.queue.empty())
+
+            pool.close()
+
+    def test_worker_pool_dead_worker(self):
+        """A worker process that dies or a result that cannot be pickled fails the job, not the pool."""
+        pool = WorkerPool(2)
+
+        try:
+            for cons_func in (dying_cons_function, unpicklable_cons_function):
+                result = pool.submit_run(gen_prod_function, [{"count": 10}], cons_func, [{}])
+
+                self.assertTrue(result["producers"][0]["result"] is None)
+                self.assertTrue(isinstance(result["consumers"][0]["exception"], RuntimeError))
+
+            result = pool.submit_run(prod_function, [{"add": 0} for i in range(2)],
+                                     cons_function, [{"add": 0} for i in range(2)])
+
+            prod_sum = sum(sum(p["result"]) for p in result["producers"])
+            cons_sum = sum(sum(c["result"]) for c in result["consumers"])
+
+            self.assertTrue(prod_sum == cons_sum)
+            self.assertTrue(len(pool.workers) == 2 and all(worker.is_alive() for worker in pool.workers))
+        finally:
+            pool.close()
+
+    def test_calculon_autoscale(self):
+        """Consumers are added while there is a backlog, every one of them reports its result."""
+        for use_threads in (True, False):
+            p_args = [{"add": 0} for i in range(40)]
+
+            c = Calculon(prod_function, p_args, True, slow_cons_function, {"add": 0}, use_threads,
+                         cons_autoscale=(1, 8), autoscale_interval=0.05)
+            result = c.start()
+
+            self.assertTrue(1 < len(result["consumers"]) <= 8)
+
+            prod_sum = sum(sum(p["result"]) for p in result["producers"])
+            cons_sum = sum(sum(c["result"]) for c in result["consumers"])
+
+            self.assertTrue(prod_sum == cons_sum)
+
+    def test_calculon_bounded_queue(self):
+        """Producers block on a full queue and report how long they waited."""
+        for use_threads in (True, False):
+            p_args = [{"add": 0} for i in range(3)]
+            c_args = [{"add": 0}]
+
+            c = Calculon(prod_function, p_args, use_threads, slow_cons_function, c_args, use_threads,
+                         max_queue_size=2)
+            result = c.start()
+
+            prod_sum = sum(sum(p["result"]) for p in result["producers"])
+            cons_sum = sum(sum(c["result"]) for c in result["consumers"])
+
+            self.assertTrue(prod_sum == cons_sum)
+            self.assertTrue(sum(p["stalled"] for p in result["producers"]) > 0)
+
+    def test_bounded_queue_failed_consumer(self):
+        """Once every consumer has failed, the queue is emptied, so that producers do not block on it forever."""
+        for use_threads in (True, False):
+            for options in ({}, {"batch_size": 2}, {"work_stealing": True}, {"partitioned": True}):
+                c = Calculon(gen_prod_function, [{"count": 10}], use_threads, failing_cons_function, [{}], use_threads,
+                             max_queue_size=2, **options)
+                result = c.start()
+
+                self.assertTrue(result["producers"][0]["items"] == 10)
+                self.assertTrue(isinstance(result["consumers"][0]["exception"], ValueError))
+
+    def test_failed_consumer_values(self):
+        """Values left behind by a consumer that fails go to the other consumers of the queue."""
+        for use_threads in (True, False):
+            for options in ({}, {"batch_size": 2}, {"work_stealing": True}):
+                # Values one by one, a chunk would go down with the consumer that took it.
+                c = Calculon(gen_prod_function, [{"count": 200}], use_threads,
+                             failing_or_count_cons_function, [{"fail": True}, {}], use_threads,
+                             max_queue_size=2, chunk_size=1, **options)
+                result = c.start()
+
+                # All but the values the consumer failed on.
+                failed = result["consumers"][0]["exception"].args[0]
+                self.assertTrue(sorted(result["consumers"][1]["result"] + failed) == list(range(0, 200)))
+
+            # A partition is only taken by its own consumer, the other one still gets all of its values.
+            c = Calculon(gen_prod_function, [{"count": 200}], use_threads,
+                         failing_or_count_cons_function, [{"fail": True}, {}], use_threads,
+                         max_queue_size=2, partitioned=True)
+            result = c.start()
+
+            self.assertTrue(result["producers"][0]["items"] == 200)
+            self.assertTrue(sorted(result["consumers"][1]["result"]) == list(range(1, 200, 2)))
+
+    def test_bounded_queue_bytes(self):
+        """Queue bounded by bytes only lets in what fits."""
+        queue = BoundedQueue(max_bytes=100, use_threads=True)
+
+        # A value larger than the limit gets in when the queue is empty.
+        queue.put(b"x" * 150)
+        self.assertRaises(Full, queue.put, b"x", False)
+        self.assertTrue(queue.get() == b"x" * 150)
+
+        queue.put(b"x" * 60)
+        self.assertRaises(Full, queue.put, b"x" * 60, True, 0.01)
+        queue.put(b"x" * 40)
+
+        self.assertTrue(queue.get() == b"x" * 60)
+        queue.put(b"x" * 60)
+
+    def test_calculon_metrics(self):
+        """Producers and consumers count values and time, the queue depth is sampled."""
+        for use_threads in (True, False):
+            p_args = [{"add": 0} for i in range(4)]
+            c_args = [{"add": 0} for i in range(2)]
+
+            c = Calculon(prod_function, p_args, use_threads, cons_function, c_args, use_threads,
+                         metrics=True, metrics_interval=0.01)
+            result = c.start()
+            metrics = result["metrics"]
+
+            self.assertTrue("metrics" not in result["producers"][0])
+            self.assertTrue(sum(m["items"] for m in metrics["producers"]) == 4 * NUM_RESULTS)
+            self.assertTrue(sum(m["items"] for m in metrics["consumers"]) == 4 * NUM_RESULTS)
+            self.assertTrue(metrics["latency"].count == 4 * NUM_RESULTS)
+            self.assertTrue(metrics["consumers"][0]["name"] == result["consumers"][0]["name"])
+            self.assertTrue(len(metrics["queue_depth"]) > 0)
+
+    def test_histogram(self):
+        """Histograms record durations into buckets and merge."""
+        first, second = Histogram(), Histogram()
+
+        for i in range(0, 99):
+            first.add(0.000003)
+
+        second.add(0.5)
+        first.merge(second)
+
+        self.assertTrue(first.count == 100)
+        self.assertTrue(first.max == 0.5)
+        self.assertTrue(0.000003 <= first.percentile(50) <= 0.000004)
+        self.assertTrue(first.percentile(100) == 0.5)
+
+    def test_calculon_stream(self):
+        """Consumer outputs are streamed while the run goes on."""
+        for prod_use_threads, cons_use_threads in [(True, True), (False, False)]:
+            c = Calculon(prod_function, [{"add": 0} for i in range(0, 4)], prod_use_threads,
+                         double_cons_function, [{} for i in range(0, 2)], cons_use_threads)
+            stream = c.stream(buffer_size=2)
+            outputs = list(stream)
+
+            produced = sum([res["result"][:-1] for res in stream.result["producers"]], [])
+            self.assertTrue(sorted(outputs) == sorted(value * 2 for value in produced))
+            self.assertTrue(len(stream.result["consumers"]) == 2)
+            self.assertTrue(list(stream) == [])
+
+    def test_pipeline(self):
+        """Values flow through every stage of a pipeline."""
+        for use_threads in [True, False]:
+            pipeline = Pipeline(prod_function, [{"add": 0} for i in range(0, 4)], use_threads, max_queue_size=2)
+            pipeline.add_stage(odd_cons_function, [{} for i in range(0, 2)], not use_threads) \
+                    .add_stage(double_cons_function, [{} for i in range(0, 2)], use_threads) \
+                    .add_stage(count_cons_function, [{} for i in range(0, 3)], use_threads)
+            result = pipeline.start()
+
+            produced = sum([res["result"][:-1] for res in result["producers"]], [])
+            received = sum([res["result"] for res in result["stages"][2]], [])
+
+            self.assertTrue(len(result["stages"]) == 3)
+            self.assertTrue(len(result["stages"][2]) == 3)
+            self.assertTrue(sorted(received) == sorted(value * 2 for value in produced if value % 2))
+
+    def test_pipeline_failed_stage(self):
+        """A stage whose consumers fail does not block the stage in front of it."""
+        for use_threads in [True, False]:
+            pipeline = Pipeline(gen_prod_function, [{"count": 50}], use_threads, max_queue_size=5)
+            pipeline.add_stage(double_cons_function, [{}], use_threads) \
+                    .add_stage(failing_cons_function, [{}], use_threads)
+            result = pipeline.start()
+
+            self.assertTrue(result["stages"][0][0]["result"] == 98)
+            self.assertTrue(isinstance(result["stages"][1][0]["exception"], ValueError))
+
+            # The other consumers of a stage take the values of the one that failed.
+            pipeline = Pipeline(gen_prod_function, [{"count": 50}], use_threads, max_queue_size=2)
+            pipeline.add_stage(double_cons_function, [{}], use_threads) \
+                    .add_stage(failing_or_count_cons_function, [{"fail": True}, {}], use_threads)
+            result = pipeline.start()
+
+            failed = result["stages"][1][0]["exception"].args[0]
+            self.assertTrue(sorted(result["stages"][1][1]["result"] + failed) == [value * 2 for value in range(0, 50)])
+
+    @unittest.skipIf(not hasattr(multiprocessing, "get_context"), "start methods require Python 3.4")
+    def test_pipeline_start_method(self):
+        """Pipeline processes and the queues between them come from the context of the start method."""
+        pipeline = Pipeline(gen_prod_function, [{"count": 10}], False, max_queue_size=2, start_method="spawn")
+        pipeline.add_stage(double_cons_function, [{}], False) \
+                .add_stage(count_cons_function, [{} for i in range(0, 2)], False)
+        result = pipeline.start()
+
+        received = sum([res["result"] for res in result["stages"][1]], [])
+        self.assertTrue(sorted(received) == [value * 2 for value in range(0, 10)])
+
+    def test_generator_producers(self):
+        """Values yielded by generator producers are put on the queue."""
+        for use_threads, batch_size, chunk_size in [(True, None, 100), (False, None, 7), (False, 4, 100),
+                                                    (False, None, None)]:
+            cons_func = batch_cons_function if batch_size else count_cons_function
+
+            c = Calculon(gen_prod_function, [{"count": 250} for i in range(0, 3)], use_threads,
+                         cons_func, [{"batch_size": batch_size} for i in range(0, 2)], use_threads,
+                         batch_size=batch_size, max_queue_size=3, chunk_size=chunk_size, metrics=True)
+            result = c.start()
+            received = sum([res["result"] for res in result["consumers"]], [])
+
+            self.assertTrue(sorted(received) == sorted(list(range(0, 250)) * 3))
+            self.assertTrue([res["items"] for res in result["producers"]] == [250] * 3)
+            self.assertTrue([res["result"] for res in result["producers"]] == [None] * 3)
+            self.assertTrue(sum(m["items"] for m in result["metrics"]["producers"]) == 750)
+            self.assertTrue(sum(m["items"] for m in result["metrics"]["consumers"]) == 750)
+
+    def test_map(self):
+        """Calculon.map keeps the order of the values."""
+        for use_threads, chunksize in [(True, 1), (False, 7), (True, 100)]:
+            result = Calculon.map(square, range(0, 50), workers=3, use_threads=use_threads, chunksize=chunksize)
+            self.assertTrue(result == [i * i for i in range(0, 50)])
+
+        self.assertTrue(Calculon.map(square, [], workers=2) == [])
+        self.assertRaises(ValueError, Calculon.map, square, range(0, 10), chunksize=0)
+
+    def test_imap(self):
+        """imap / imap_unordered read the input lazily and raise exceptions of func."""
+        read = []
+
+        def values():
+            for i in range(0, 1000):
+                read.append(i)
+                yield i
+
+        results = Calculon.imap(square, values(), workers=2, use_threads=True, chunksize=10, max_pending=2)
+        self.assertTrue([next(results) for i in range(0, 5)] == [0, 1, 4, 9, 16])
+
+        # At most max_pending chunks past the one being yielded, and one being put together.
+        self.assertTrue(len(read) <= 40)
+        results.close()
+
+        results = Calculon.imap_unordered(square, range(0, 100), workers=4, use_threads=False, chunksize=3)
+        self.assertTrue(sorted(results) == [i * i for i in range(0, 100)])
+
+        results = Calculon.imap(square, [1, 2, -1, 3] * 10, workers=2, use_threads=False)
+        self.assertRaises(ValueError, list, results)
+
+    def test_partitioned(self):
+        """Values with the same key always go to the same consumer."""
+        for use_threads, key in [(True, None), (False, None), (False, parity)]:
+            c = Calculon(gen_prod_function, [{"count": 100} for i in range(0, 3)], use_threads,
+                         count_cons_function, [{} for i in range(0, 4)], use_threads,
+                         partitioned=True, partition_key=key, max_queue_size=5)
+            result = c.start()
+
+            keys = [set(key(value) if key else value for value in res["result"]) for res in result["consumers"]]
+            received = sum([res["result"] for res in result["consumers"]], [])
+
+            self.assertTrue(sorted(received) == sorted(list(range(0, 100)) * 3))
+            self.assertTrue(sum(len(k) for k in keys) == len(set.union(*keys)))
+
+        self.assertRaises(ValueError, Calculon, prod_function, [], True, cons_function, [], True,
+                          partitioned=True, batch_size=10)
+
+    def test_partitioned_queue(self):
+        """Strings are routed the same way in every process."""
+        queue = PartitionedQueue(3, use_threads=True)
+
+        for value in ["a", "b", "c", "d", "a", "b", "a"]:
+            queue.put(value)
+
+        self.assertTrue(queue.qsize() == 7)
+        sizes = sorted(queue.partition(i).qsize() for i in range(0, 3))
+        self.assertTrue(sum(sizes) == 7 and sizes[-1] >= 3)
+        self.assertTrue(_hash("user-1") == _hash(u"user-1") == _hash(b"user-1") == 2116437524)
+        self.assertTrue(_hash(("user", "1")) == _hash((u"user", b"1")) == 970841952)
+        self.assertTrue(_hash(frozenset(["a", "b", None])) == _hash(frozenset([None, "b", "a"])))
+        self.assertTrue(_hash(None) == 0 and _hash(7) == 7)
+
+    @unittest.skipIf(not hasattr(multiprocessing, "get_context"), "start methods require Python 3.4")
+    def test_partitioned_spawn(self):
+        """Tuple keys are routed the same way by producer processes with their own hash salt."""
+        c = Calculon(user_prod_function, [{"count": 50} for i in range(0, 4)], False,
+                     count_cons_function, [{} for i in range(0, 3)], False,
+                     partitioned=True, partition_key=user_key, start_method="spawn")
+        result = c.start()
+
+        keys = [set(user_key(value) for value in res["result"]) for res in result["consumers"]]
+
+        self.assertTrue(sum(len(res["result"]) for res in result["consumers"]) == 200)
+        self.assertTrue(sum(len(k) for k in keys) == len(set.union(*keys)) == 5)
+
+    def test_work_stealing(self):
+        """Consumers steal from each other and every value is processed once."""
+        for use_threads, chunk in [(True, 1), (False, 10), (True, 10)]:
+            c = Calculon(gen_prod_function, [{"count": 200} for i in range(0, 2)], use_threads,
+                         skewed_cons_function, [{} for i in range(0, 4)], use_threads,
+                         work_stealing=True, distribution_chunk=chunk, metrics=True)
+            result = c.start()
+
+            received = sum([res["result"] for res in result["consumers"]], [])
+            self.assertTrue(sorted(received) == sorted(list(range(0, 200)) * 2))
+
+            # With chunks of 10, the slow values all land on the same queue at first.
+            if chunk == 10:
+                slow = [len([value for value in res["result"] if value % 10 == 0]) for res in result["consumers"]]
+                self.assertTrue(len([count for count in slow if count]) > 1)
+
+    def test_work_stealing_queue(self):
+        """An idle consumer steals half of the backlog of the busiest queue."""
+        queue = WorkStealingQueue(3, chunk=10, use_threads=True)
+
+        for i in range(0, 10):
+            queue.put(i)
+
+        first, second = queue.local(0), queue.local(1)
+        self.assertTrue(second.get() == 0)
+        self.assertTrue(list(second.stolen) == [1, 2, 3, 4])
+        self.assertTrue(first.get() == 5)
+
+        queue.close()
+        self.assertTrue([first.get() for i in range(0, 4)] == [6, 7, 8, 9])
+        self.assertTrue(isinstance(first.get(), _Sentinel))
+        self.assertTrue([second.get() for i in range(0, 4)] == [1, 2, 3, 4])
+        self.assertTrue(isinstance(second.get(), _Sentinel))
+
+    def test_work_stealing_producers(self):
+        """Producer processes start on different queues, in every run."""
+        queue = WorkStealingQueue(3)
+
+        for run in range(1, 3):
+            producers = [multiprocessing.Process(target=put_values, args=(queue, 1)) for i in range(0, 3)]
+
+            for producer in producers:
+                producer.start()
+
+            for producer in producers:
+                producer.join()
+
+            self.assertTrue([q.qsize() for q in queue.queues] == [run] * 3)
+
+    @unittest.skipIf(not hasattr(multiprocessing, "get_context"), "start methods require Python 3.4")
+    def test_start_method(self):
+        """Workers are started with the given start method and report their startup time."""
+        for start_method in ["spawn", "forkserver"]:
+            c = Calculon(prod_function, [{"add": 1} for i in range(0, 2)], False,
+                         cons_function, [{"add": 2} for i in range(0, 2)], False,
+                         start_method=start_method, preload=["random"])
+            result = c.start()
+
+            produced = sum([res["result"][:-1] for res in result["producers"]], [])
+            received = sum([res["result"][:-1] for res in result["consumers"]], [])
+
+            self.assertTrue(sorted(produced) == sorted(received))
+            self.assertTrue(all(res["startup"] > 0 for res in result["producers"] + result["consumers"]))
+
+    def test_start_method_fallback(self):
+        """Threads do not report startup, fork works everywhere."""
+        c = Calculon(prod_function, [{"add": 1}], True, cons_function, [{"add": 2}], False, start_method="fork")
+        result = c.start()
+
+        self.assertTrue("startup" not in result["producers"][0])
+        self.assertTrue(result["consumers"][0]["startup"] >= 0)
+
+        if not hasattr(multiprocessing, "get_context"):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                c = Calculon(prod_function, [{"add": 1}], False, cons_function, [{"add": 2}], False,
+                             start_method="spawn")
+
+            self.assertTrue(c.start_method is None)
+            self.assertTrue(len(caught) == 1)
+
+    @unittest.skipIf(not hasattr(os, "sched_setaffinity"), "CPU affinity requires os.sched_setaffinity")
+    def test_cpu_affinity(self):
+        """Processes are pinned to CPUs and report them, threads are not pinned."""
+        available = sorted(os.sched_getaffinity(0))
+
+        c = Calculon(prod_function, [{"add": 1}], True, cons_function, [{"add": 2} for i in range(0, 3)], False,
+                     cpu_affinity=[available[-1], available[:2]])
+        result = c.start()
+
+        self.assertTrue("cpus" not in result["producers"][0])
+        self.assertTrue([res["cpus"] for res in result["consumers"]] ==
+                        [[available[-1]], available[:2], [available[-1]]])
+
+        for policy in ["compact", "spread"]:
+            c = Calculon(prod_function, [{"add": 1}], False, cons_function, [{"add": 2}], False, cpu_affinity=policy)
+            result = c.start()
+
+            cpus = [res["cpus"] for res in result["producers"] + result["consumers"]]
+            self.assertTrue(all(len(cpu) == 1 and cpu[0] in available for cpu in cpus))
+
+            if len(available) > 1:
+                self.assertTrue(cpus[0] != cpus[1])
+
+        self.assertRaises(ValueError, Calculon, prod_function, [], True, cons_function, [], True,
+                          cpu_affinity="nearest")
+
+    def test_spilling(self):
+        """Values beyond the in-memory limit go to disk and come back in order."""
+        for use_threads, batch_size in [(True, None), (False, None), (False, 3)]:
+            cons_func = batch_cons_function if batch_size else count_cons_function
+
+            c = Calculon(gen_prod_function, [{"count": 500}], use_threads,
+                         cons_func, [{"batch_size": batch_size}], use_threads,
+                         spill_after=5, spill_segment_size=1024, batch_size=batch_size, chunk_size=None)
+            result = c.start()
+
+            # One producer and one consumer, so the order is kept.
+            self.assertTrue(result["consumers"][0]["result"] == list(range(0, 500)))
+            self.assertTrue(result["spilled"] > 0)
+            self.assertTrue(not os.path.exists(c.queue.directory))
+
+    def test_spilling_queue(self):
+        """Segment files are read in order and deleted once read."""
+        directory = tempfile.mkdtemp()
+
+        try:
+            queue = SpillingQueue(2, directory, segment_size=64, use_threads=True)
+
+            for i in range(0, 20):
+                queue.put("value {0}".format(i))
+
+            self.assertTrue(queue.qsize() == 20 and queue.spilled() == 18)
+            self.assertTrue(len(os.listdir(directory)) > 2)
+
+            self.assertTrue([queue.get() for i in range(0, 10)] == ["value {0}".format(i) for i in range(0, 10)])
+            queue.put("last")
+
+            self.assertTrue([queue.get() for i in range(0, 11)] ==
+                            ["value {0}".format(i) for i in range(10, 20)] + ["last"])
+            self.assertTrue(os.listdir(directory) == [])
+            self.assertRaises(Empty, queue.get, True, 0.01)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cache(self):
+        """Results of duplicate values come from the cache shared by the consumers."""
+        for use_threads in [True, False]:
+            c = Calculon(gen_prod_function, [{"count": 100} for i in range(0, 2)], use_threads,
+                         expensive_cons_function, [{} for i in range(0, 3)], use_threads,
+                         cache_size=10, cache_key=lambda value: value % 10)
+            stream = c.stream()
+            outputs = list(stream)
+
+            counts = [res["cache"] for res in stream.result["consumers"]]
+
+            self.assertTrue(sorted(value for value, name in outputs) == sorted(list(range(0, 10)) * 20))
+            self.assertTrue(sum(count["hits"] + count["misses"] for count in counts) == 200)
+            self.assertTrue(sum(count["hits"] for count in counts) > 150)
+
+            # Each cached output is streamed by whichever consumer finds it, without replacing its `_result`.
+            names = set(res["name"] for res in stream.result["consumers"])
+            self.assertTrue(set(name for value, name in outputs) <= names)
+            self.assertTrue(all(res["result"] == 0 for res in stream.result["consumers"]))
+
+            c = Calculon(gen_prod_function, [{"count": 10}], use_threads,
+                         expensive_cons_function, [{}], use_threads, cache_size=10)
+            self.assertRaises(ValueError, c.start)
+
+    def test_lru_cache(self):
+        """The least recently used result is evicted."""
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertTrue(cache.get("a") == (True, 1))
+        self.assertTrue(cache.get("b") == (False, None))
+        self.assertTrue(len(cache) == 2)
+
+    def test_remote(self):
+        """Consumers of several nodes share the queue served over TCP."""
+        import socket
+
+        # Find a free port.
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        address = sock.getsockname()
+        sock.close()
+
+        authkey = b"calculon"
+
+        nodes = [multiprocessing.Process(target=run_node, args=(address, authkey, 2, use_threads, 3))
+                 for use_threads in [True, False]]
+
+        for node in nodes:
+            node.start()
+
+        c = Calculon(prod_function, [{"add": 0} for i in range(0, 10)], False,
+                     cons_function, [{"add": i} for i in range(0, 4)], False,
+                     remote_address=address, authkey=authkey)
+        result = c.start()
+
+        for node in nodes:
+            node.join()
+            self.assertTrue(node.exitcode == 0)
+
+        prod_sum = sum(sum(p["result"]) for p in result["producers"])
+        cons_sum = sum(sum(c["result"]) for c in result["consumers"])
+
+        self.assertTrue(len(result["consumers"]) == 4)
+        self.assertTrue(prod_sum + sum(range(0, 4)) == cons_sum)
+
+        # Results are in the order of the slots.
+        self.assertTrue([c["result"][-1] for c in result["consumers"]] == list(range(0, 4)))
+
+        self.assertRaises(ValueError, Calculon, prod_function, [], False, cons_function, [], False,
+                          remote_address=address)
+
+    def test_cancel(self):
+        """A consumer that finds what the run is looking for stops it."""
+        for use_threads in [True, False]:
+            c = Calculon(endless_prod_function, [{} for i in range(0, 2)], use_threads,
+                         search_cons_function, [{"target": 1000} for i in range(0, 3)], use_threads,
+                         max_queue_size=100, cancellable=True)
+
+            started = time.time()
+            result = c.start()
+
+            self.assertTrue(time.time() - started < 10)
+            self.assertTrue(result["cancelled"])
+            self.assertTrue(1000 in [res["result"] for res in result["consumers"]])
+            self.assertTrue(all(res["cancelled"] for res in result["producers"]))
+
+    def test_deadline(self):
+        """A run that outlives its deadline is cancelled."""
+        for use_threads in [True, False]:
+            c = Calculon(endless_prod_function, [{} for i in range(0, 2)], use_threads,
+                         search_cons_function, [{"target": -1} for i in range(0, 2)], use_threads,
+                         deadline=0.5)
+
+            started = time.time()
+            result = c.start()
+
+            self.assertTrue(0.5 <= time.time() - started < 10)
+            self.assertTrue(result["cancelled"])
+            self.assertTrue(all(res["cancelled"] and res["result"] is None for res in result["producers"]))
+
+        # Nothing to cancel, the run completes.
+        c = Calculon(prod_function, [{"add": 0}], True, cons_function, [{"add": 0}], True, deadline=60)
+        result = c.start()
+
+        self.assertFalse(result["cancelled"])
+        self.assertFalse(result["consumers"][0]["cancelled"])
+
+        c = Calculon(prod_function, [{"add": 0}], True, cons_function, [{"add": 0}], True)
+        self.assertRaises(ValueError, c.cancel)
+
+    def test_retries(self):
+        """An exception fails the value, not the consumer."""
+        for use_threads in [True, False]:
+            c = Calculon(gen_prod_function, [{"count": 20}], use_threads,
+                         flaky_cons_function, [{} for i in range(0, 2)], use_threads, max_retries=2)
+            result = c.start()
+
+            values = [value for res in result["consumers"] for value in res["result"] or []]
+
+            self.assertTrue(sorted(values) == list(range(1, 20)))
+            self.assertTrue(len(result["dead_letters"]) == 1)
+            self.assertTrue(result["dead_letters"][0]["value"] == 0)
+            self.assertTrue(result["dead_letters"][0]["attempts"] == 3)
+            self.assertTrue(isinstance(result["dead_letters"][0]["exception"], ValueError))
+
+    def test_respawn(self):
+        """A consumer process that dies is replaced and its value is retried."""
+        directory = tempfile.mkdtemp()
+
+        try:
+            c = Calculon(gen_prod_function, [{"count": 20}], True,
+                         crashing_cons_function, [{"directory": directory} for i in range(0, 2)], False,
+                         max_retries=1, respawn=True)
+            result = c.start()
+
+            retried = os.path.exists(os.path.join(directory, "retried"))
+        finally:
+            shutil.rmtree(directory)
+
+        # One replacement for 5, two for 13.
+        self.assertTrue(len(result["consumers"]) == 5)
+        self.assertTrue(len([res for res in result["consumers"] if "exception" in res]) == 3)
+
+        values = [value for res in result["consumers"] if "result" in res for value in res["result"]]
+
+        self.assertTrue(retried)
+        self.assertTrue(13 not in values)
+
+        self.assertTrue(len(result["dead_letters"]) == 1)
+        self.assertTrue(result["dead_letters"][0]["value"] == 13)
+        self.assertTrue(result["dead_letters"][0]["attempts"] == 2)
+        self.assertTrue(isinstance(result["dead_letters"][0]["exception"], RuntimeError))
+
+    def test_dead_consumers_bounded_queue(self):
+        """Consumer processes that die do not leave start() blocked on a full queue."""
+        # Every replacement dies as well, one end-of-work marker per replacement would not fit.
+        c = Calculon(gen_prod_function, [{"count": 5}], True, dying_cons_function, [{}], False,
+                     max_queue_size=2, respawn=True, max_retries=0)
+        result = c.start()
+
+        self.assertTrue(len(result["consumers"]) == 6)
+        self.assertTrue(sorted(letter["value"] for letter in result["dead_letters"]) == list(range(0, 5)))
+
+        # Nothing takes the values of a consumer that died and is not replaced.
+        c = Calculon(gen_prod_function, [{"count": 5}], True, dying_cons_function, [{}], False, max_queue_size=2)
+        result = c.start()
+
+        self.assertTrue(result["producers"][0]["items"] == 5)
+        self.assertTrue(isinstance(result["consumers"][0]["exception"], RuntimeError))
+
+    def test_metrics_dead_process(self):
+        """Processes that die have no metrics, the others still do."""
+        directory = tempfile.mkdtemp()
+
+        try:
+            c = Calculon(gen_prod_function, [{"count": 20}], True,
+                         crashing_cons_function, [{"directory": directory} for i in range(0, 2)], False,
+                         max_retries=1, respawn=True, metrics=True)
+            result = c.start()
+        finally:
+            shutil.rmtree(directory)
+
+        consumers = result["metrics"]["consumers"]
+
+        self.assertTrue(len(consumers) == 5)
+        self.assertTrue(len([m for m in consumers if m is None]) == 3)
+        self.assertTrue(result["metrics"]["latency"].count == sum(m["items"] for m in consumers if m is not None))
+
+        c = Calculon(dying_prod_function, [{}], False, count_cons_function, [{}], True, metrics=True)
+        result = c.start()
+
+        self.assertTrue(isinstance(result["producers"][0]["exception"], RuntimeError))
+        self.assertTrue(result["metrics"]["producers"] == [None])
+        self.assertTrue(result["metrics"]["consumers"][0]["items"] == 0)
+
+    def test_journal(self):
+        """A journal holds the last record written to it, a record cut short reads as none."""
+        journal = _Journal()
+
+        try:
+            self.assertTrue(journal.read() is None)
+
+            journal.write((0, b"x" * 1000, 0))
+            journal.write((1, "y", 2))
+            self.assertTrue(journal.read() == (1, "y", 2))
+
+            journal._write(0, b"\0" * 8)
+            self.assertTrue(journal.read() is None)
+        finally:
+            journal.close()
+
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_profile(self):
+        """Stats of every worker are merged into one file."""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "calculon.prof")
+
+        try:
+            for use_threads in [True, False]:
+                with warnings.catch_warnings(record=True):
+                    warnings.simplefilter("always")
+
+                    c = Calculon(prod_function, [{"add": 0} for i in range(0, 2)], use_threads,
+                                 cons_function, [{"add": 0} for i in range(0, 3)], use_threads,
+                                 profile=path, profile_memory=True)
+                    result = c.start()
+
+                self.assertTrue(all("profile" not in res for res in result["producers"] + result["consumers"]))
+
+                functions = set(function for filename, line, function in pstats.Stats(path).stats)
+                self.assertTrue("prod_function" in functions and "cons_function" in functions)
+                self.assertTrue(result["profile"]["stats"].total_calls > 0)
+
+                memory = result["profile"]["memory"]
+
+                if sys.version_info < (3, 4):
+                    self.assertTrue(memory == [])
+                elif use_threads:
+                    self.assertTrue([entry["name"] for entry in memory] == ["main"])
+                else:
+                    self.assertTrue(sorted(entry["role"] for entry in memory) == ["consumer"] * 3 + ["producer"] * 2)
+                    self.assertTrue(all(entry["peak"] > 0 for entry in memory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_trace(self):
+        """Spans of every worker end up on the timeline, each worker in a row of its own."""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "trace.json")
+
+        try:
+            for use_threads in [True, False]:
+                c = Calculon(prod_function, [{"add": 0} for i in range(0, 2)], use_threads,
+                             cons_function, [{"add": 0} for i in range(0, 3)], use_threads,
+                             max_queue_size=1, trace=path, trace_buffer=5)
+                result = c.start()
+
+                self.assertTrue(all("trace" not in res for res in result["producers"] + result["consumers"]))
+
+                with open(path) as trace_file:
+                    events = json.load(trace_file)["traceEvents"]
+
+                rows = dict((event["tid"], event["args"]["name"]) for event in events if event["name"] == "thread_name")
+                self.assertTrue(sorted(rows.values()) == ["calculon", "consumer 0", "consumer 1", "consumer 2",
+                                                          "producer 0", "producer 1"])
+
+                spans = [event for event in events if event["ph"] == "X"]
+                names = set(event["name"] for event in spans)
+
+                self.assertTrue(set(["prod_func", "cons_func", "queue.get", "run", "join producers",
+                                     "join consumers", "start consumer 2"]) <= names)
+                self.assertTrue(all(event["dur"] >= 0 for event in spans))
+
+                # Consumers record more than 5 spans, the oldest ones are dropped.
+                per_row = [len([event for event in spans if event["tid"] == tid]) for tid in rows]
+                self.assertTrue(max(per_row) == 5)
+                self.assertTrue(any(event["name"] == "dropped" for event in events))
+
+                if not use_threads:
+                    self.assertTrue("startup" in names)
+        finally:
+            shutil.rmtree(directory)
+
     def test_exceptions(self):
         """Checks that exceptions don't kill Calculon"""
         NUM_PROD = 1
@@ -25,6 +25,7 @@ setup(
                  'Operating System :: POSIX',
                  'Operating System :: Microsoft :: Windows',
                  'Programming Language :: Python :: 2.7',
+                 'Programming Language :: Python :: 3',
                  'Topic :: System :: Distributed Computing'],
     test_suite='calculon.test',
     packages=['calculon', 'calculon.test'],